@@ -0,0 +1,370 @@
+import os
+import numpy as np
+from time import perf_counter
+from pynndescent import NNDescent
+from pynndescent.distances import named_distances
+from scipy.sparse import issparse
+from benchmark.fixtures import FIXTURE_DIR
+from server import data
+from server.evaluation import compute_overlap, compute_recall, exact_neighbors
+from server.instrumentation import get_memory_usage, reset_peak_rss
+from server.shards import SHARD_MERGE_COUNT, get_candidate_rows
+from server.updater import EXACT_GRAPH_ROWS, build_neighbor_graph, build_nndescent as build_topic_graph, combined_distance
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+NUM_TOPICS = 25
+N_NEIGHBORS = 30
+TOPIC_FIXTURE_PATH = os.path.join(FIXTURE_DIR, 'topics.npz')
+
+# {name: distance function}, combined is the metric of the recommendations
+METRICS = {
+    'combined': combined_distance,
+    'cosine': named_distances['cosine'],
+    'hellinger': named_distances['hellinger'],
+    'jensen_shannon': named_distances['jensen_shannon'],
+}
+
+
+def make_topic_matrix(n_rows: int, num_topics=NUM_TOPICS, num_categories=12, main_topics=3, seed=0):
+    """
+    Synthetic topic distributions: every category has a few main topics,
+    its articles are drawn from a sparse Dirichlet centered on them.
+
+    Returns
+    ----------
+    tuple[np.ndarray, np.ndarray]
+        (n_rows, num_topics) float32 topic distributions and the category of every row.
+    """
+
+    rng = np.random.default_rng(seed)
+    priors = np.full((num_categories, num_topics), 0.02)
+    for category in range(num_categories):
+        priors[category, rng.choice(num_topics, main_topics, replace=False)] = 0.5
+
+    categories = rng.integers(0, num_categories, n_rows)
+    # gamma draws normalized by row = one Dirichlet draw per row with the prior of its category
+    topics = rng.gamma(priors[categories])
+    topics /= np.maximum(topics.sum(axis=1, keepdims=True), np.finfo(np.float64).tiny)
+    return topics.astype(np.float32), categories
+
+
+def export_topic_fixture(filepath=TOPIC_FIXTURE_PATH):
+    """
+    Save the topic distributions and the categories of the published generation as a local fixture.
+    """
+
+    published = data.load_generation(data.get_published_generation())
+    category_by_id = {doc['_id']: doc['category'] for doc in data.get_category_list('newspaper')}
+    topics = data.load_topic_distributions(generation=published['generation'])
+    categories = np.array([category_by_id.get(article_id, '') for article_id in published['article_ids']])
+
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    np.savez_compressed(filepath, topics=topics, categories=categories)
+    print(f'Saved {topics.shape[0]} topic distributions to {filepath}')
+
+
+def load_topic_fixture(filepath=TOPIC_FIXTURE_PATH):
+    """
+    Returns
+    ----------
+    tuple[np.ndarray, np.ndarray]
+        Topic distributions and categories of the fixture.
+    """
+
+    with np.load(filepath) as fixture:
+        return fixture['topics'].astype(np.float32), fixture['categories']
+
+
+def compute_category_accuracy(neighbor_graph: np.ndarray, categories: np.ndarray, top_n=10):
+    """
+    Share of the top_n recommendations (the first neighbor is the article itself) in the category of the article.
+    """
+
+    recommendations = neighbor_graph[:, 1:top_n + 1]
+    valid = recommendations >= 0
+    same_category = categories[np.where(valid, recommendations, 0)] == categories[:, None]
+    return (same_category & valid).sum() / max(valid.sum(), 1)
+
+
+def build_nndescent(matrix, metric: str, **params):
+    index = NNDescent(matrix, metric=METRICS[metric], n_neighbors=N_NEIGHBORS, random_state=0, **params)
+
+    def query(queries, k):
+        return index.query(queries, k=k)[0]
+
+    return index.neighbor_graph[0], query, index.prepare
+
+
+def build_hnswlib(matrix, metric: str, ef_construction=200, m=16):
+    # hnswlib only has the cosine of these metrics, its graph is read back with a query of every row
+    index = hnswlib.Index(space='cosine', dim=matrix.shape[1])
+    index.init_index(max_elements=matrix.shape[0], ef_construction=ef_construction, M=m, random_seed=0)
+    index.add_items(matrix)
+    index.set_ef(max(N_NEIGHBORS * 2, 50))
+
+    def query(queries, k):
+        return index.knn_query(queries, k=k)[0]
+
+    return query(matrix, N_NEIGHBORS).astype(np.int64), query, None
+
+
+# {name: (build function, supported metrics or None for all)}
+BACKENDS = {
+    'nndescent': (build_nndescent, None),
+    'nndescent_fast': (lambda matrix, metric: build_nndescent(matrix, metric, n_iters=4, max_candidates=20), None),
+}
+if hnswlib is not None:
+    BACKENDS['hnswlib'] = (build_hnswlib, {'cosine'})
+
+
+def measure(function):
+    reset_peak_rss()
+    start_time = perf_counter()
+    result = function()
+    return result, perf_counter() - start_time, get_memory_usage()['peak_rss_mb']
+
+
+def benchmark_ann(sizes=(10_000, 100_000), backends=None, metrics=('combined', 'cosine'), n_queries=200,
+                  top_n=10, k=10, fixture_path: str = None, seed=0):
+    """
+    Build the recommendation graph for every size, backend and metric, then report the build time,
+    the peak memory, the query time and the recall against the exact kNN of sampled rows.
+    The category accuracy (as data.test_accuracy) uses the categories of the synthetic rows
+    or of the local fixture (export_topic_fixture) when fixture_path is given.
+
+    The first build of a metric includes the numba compilation, warmup builds on a small matrix exclude it.
+
+    Returns
+    ----------
+    list[dict]
+        {'rows', 'backend', 'metric', 'build_seconds', 'peak_rss_mb', 'query_seconds',
+        'graph_recall', 'query_recall', 'category_accuracy'}
+    """
+
+    if fixture_path is not None:
+        fixture_topics, fixture_categories = load_topic_fixture(fixture_path)
+        sizes = [fixture_topics.shape[0] - n_queries]
+
+    rng = np.random.default_rng(seed)
+    backends = backends or list(BACKENDS)
+    warmup_matrix, _ = make_topic_matrix(500, seed=seed)
+
+    results = []
+    print(f"{'rows':>9} {'backend':<15} {'metric':<15} {'build':>9} {'peak RSS':>10} {'query':>10} "
+          f"{'graph R@k':>9} {'query R@k':>9} {'category':>9}")
+    for size in sizes:
+        if fixture_path is not None:
+            matrix, categories = fixture_topics[:size], fixture_categories[:size]
+            queries = fixture_topics[size:]
+        else:
+            matrix, categories = make_topic_matrix(size + n_queries, seed=seed)
+            matrix, categories, queries = matrix[:size], categories[:size], matrix[size:]
+        sample = rng.choice(size, min(n_queries, size), replace=False)
+
+        for metric in metrics:
+            distance = METRICS[metric]
+            exact_graph = exact_neighbors(matrix, matrix[sample], k, distance)
+            exact_queries = exact_neighbors(matrix, queries, k, distance)
+
+            for backend in backends:
+                build, supported_metrics = BACKENDS[backend]
+                if supported_metrics is not None and metric not in supported_metrics:
+                    continue
+
+                build(warmup_matrix, metric)
+                (neighbor_graph, query, prepare), build_time, peak_rss = measure(lambda: build(matrix, metric))
+                if prepare is not None:
+                    prepare()
+                query(queries[:1], k)
+                approximate_queries, query_time, _ = measure(lambda: query(queries, k))
+
+                result = {
+                    'rows': size,
+                    'backend': backend,
+                    'metric': metric,
+                    'build_seconds': build_time,
+                    'peak_rss_mb': peak_rss,
+                    'query_seconds': query_time / len(queries),
+                    'graph_recall': compute_recall(neighbor_graph[sample], exact_graph),
+                    'query_recall': compute_recall(approximate_queries, exact_queries),
+                    'category_accuracy': compute_category_accuracy(neighbor_graph, categories, top_n),
+                }
+                results.append(result)
+                print(f"{size:>9} {backend:<15} {metric:<15} {build_time:>8.2f}s {peak_rss:>8.0f}MB "
+                      f"{result['query_seconds'] * 1e6:>8.0f}us {result['graph_recall']:>9.3f} "
+                      f"{result['query_recall']:>9.3f} {result['category_accuracy']:>9.2%}")
+
+    return results
+
+
+def get_storage_bytes(topics):
+    """
+    Size of the topic distributions as saved by data.save_topic_distributions.
+    """
+
+    if issparse(topics):
+        return topics.data.size * 2 + topics.indices.size + topics.indptr.nbytes
+    return topics.nbytes
+
+
+def benchmark_topic_storage(size=20_000, storages=('float32', 'float16', 'uint8', 'sparse'), top_ks=(4, 8, 12),
+                            n_queries=200, k=10, top_n=10, seed=0):
+    """
+    Build the recommendation graph from every topic storage (data.compress_topic_distributions)
+    and compare it with the graph of the float64 rows: size on disk, build time and peak memory,
+    recall against the exact kNN of the float64 rows, overlap with the float64 graph and category accuracy.
+
+    Returns
+    ----------
+    list[dict]
+    """
+
+    matrix, categories = make_topic_matrix(size, seed=seed)
+    matrix = matrix.astype(np.float64)
+    sample = np.random.default_rng(seed).choice(size, min(n_queries, size), replace=False)
+    exact_graph = exact_neighbors(matrix, matrix[sample], k, combined_distance)
+
+    setups = [('float64', None)] + [
+        (storage, top_k) for storage in storages for top_k in (top_ks if storage == 'sparse' else [None])
+    ]
+    build_topic_graph(data.compress_topic_distributions(matrix[:500], 'float32'))
+    build_topic_graph(data.compress_topic_distributions(matrix[:500], 'sparse'))
+
+    results = []
+    reference_graph = None
+    print(f"{'storage':<12} {'size':>10} {'build':>9} {'peak RSS':>10} {'recall':>8} {'overlap':>8} {'category':>9}")
+    for storage, top_k in setups:
+        topics = matrix if storage == 'float64' else data.compress_topic_distributions(matrix, storage, top_k)
+        index, build_time, peak_rss = measure(lambda: build_topic_graph(topics))
+        neighbor_graph = index.neighbor_graph[0]
+        if reference_graph is None:
+            reference_graph = neighbor_graph
+
+        name = storage if top_k is None else f'{storage}@{top_k}'
+        result = {
+            'storage': name,
+            'bytes': get_storage_bytes(topics),
+            'build_seconds': build_time,
+            'peak_rss_mb': peak_rss,
+            'recall': compute_recall(neighbor_graph[sample], exact_graph),
+            'overlap': compute_overlap(neighbor_graph, reference_graph, top_n),
+            'category_accuracy': compute_category_accuracy(neighbor_graph, categories, top_n),
+        }
+        results.append(result)
+        print(f"{name:<12} {result['bytes'] / 2 ** 20:>8.2f}MB {build_time:>8.2f}s {peak_rss:>8.0f}MB "
+              f"{result['recall']:>8.3f} {result['overlap']:>8.2%} {result['category_accuracy']:>9.2%}")
+
+    return results
+
+
+def benchmark_two_stage(sizes=(10_000, 100_000), candidate_hops=(0, 2, 4), storage='sparse', n_queries=200,
+                        k=10, top_n=10, seed=0):
+    """
+    Compare the two stage build (Hellinger candidates re-ranked with combined_distance) with NNDescent
+    on combined_distance (the current graph): build time, recall against the exact kNN,
+    overlap with the current graph and category accuracy.
+
+    Returns
+    ----------
+    list[dict]
+    """
+
+    warmup_topics = data.compress_topic_distributions(make_topic_matrix(500, seed=seed)[0], storage)
+    build_neighbor_graph(warmup_topics, graph_build='nndescent')
+    build_neighbor_graph(warmup_topics, graph_build='two_stage')
+
+    results = []
+    print(f"{'rows':>9} {'build':<16} {'build time':>10} {'peak RSS':>10} {'recall':>8} {'overlap':>8} {'category':>9}")
+    for size in sizes:
+        matrix, categories = make_topic_matrix(size, seed=seed)
+        topics = data.compress_topic_distributions(matrix, storage)
+        sample = np.random.default_rng(seed).choice(size, min(n_queries, size), replace=False)
+        exact_graph = exact_neighbors(matrix, matrix[sample], k, combined_distance)
+
+        setups = [('nndescent', None)] + [('two_stage', hops) for hops in candidate_hops]
+        reference_graph = None
+        for graph_build, hops in setups:
+            neighbor_graph, build_time, peak_rss = measure(lambda: build_neighbor_graph(
+                topics, graph_build=graph_build, candidate_hops=hops or 0
+            ))
+            if reference_graph is None:
+                reference_graph = neighbor_graph
+
+            name = graph_build if hops is None else f'{graph_build}+{hops}hops'
+            result = {
+                'rows': size,
+                'build': name,
+                'build_seconds': build_time,
+                'peak_rss_mb': peak_rss,
+                'recall': compute_recall(neighbor_graph[sample], exact_graph),
+                'overlap': compute_overlap(neighbor_graph, reference_graph, top_n),
+                'category_accuracy': compute_category_accuracy(neighbor_graph, categories, top_n),
+            }
+            results.append(result)
+            print(f"{size:>9} {name:<16} {build_time:>9.2f}s {peak_rss:>8.0f}MB {result['recall']:>8.3f} "
+                  f"{result['overlap']:>8.2%} {result['category_accuracy']:>9.2%}")
+
+    return results
+
+
+def benchmark_shards(months=6, rows_per_month=20_000, n_queries=200, k=10, seed=0):
+    """
+    Compare an update of the monthly shards (only the graph of the current month is rebuilt) with the rebuild
+    of a single graph of every row: build time, peak memory, then the recall of the neighbors merged across
+    the recent shards (shards.get_candidate_rows) against the exact kNN of the recent rows and the query time.
+
+    Returns
+    ----------
+    dict
+    """
+
+    matrix, _ = make_topic_matrix(months * rows_per_month, seed=seed)
+    build_neighbor_graph(data.compress_topic_distributions(matrix[:2 * EXACT_GRAPH_ROWS]))
+
+    _, full_time, full_rss = measure(lambda: build_neighbor_graph(data.compress_topic_distributions(matrix)))
+    shards = []
+    for month in range(months):
+        rows = np.arange(month * rows_per_month, (month + 1) * rows_per_month)
+        graph, shard_time, shard_rss = measure(
+            lambda: build_neighbor_graph(data.compress_topic_distributions(matrix[rows]))
+        )
+        shards.append({'frozen': month < months - 1, 'graph': graph, 'rows': rows})
+
+    current = {
+        'topics': data.to_sparse_topic_distributions(data.compress_topic_distributions(matrix)),
+        'shards': shards,
+        'row_shards': np.repeat(np.arange(months, dtype=np.int32), rows_per_month),
+        'local_rows': np.tile(np.arange(rows_per_month), months),
+    }
+    recent_rows = np.arange(max(months - SHARD_MERGE_COUNT, 0) * rows_per_month, months * rows_per_month)
+    sample = np.random.default_rng(seed).choice(recent_rows, min(n_queries, len(recent_rows)), replace=False)
+    exact_graph = exact_neighbors(matrix[recent_rows], matrix[sample], k, combined_distance) + recent_rows[0]
+
+    get_candidate_rows(current, int(sample[0]), k)
+    start_time = perf_counter()
+    merged_graph = np.array([get_candidate_rows(current, int(row), k)[:k] for row in sample])
+    query_time = (perf_counter() - start_time) / len(sample)
+
+    result = {
+        'rows': len(matrix),
+        'full_build_seconds': full_time,
+        'full_peak_rss_mb': full_rss,
+        'shard_build_seconds': shard_time,
+        'shard_peak_rss_mb': shard_rss,
+        'merged_recall': compute_recall(merged_graph, exact_graph),
+        'query_ms': query_time * 1000,
+    }
+    print(f"{months} months of {rows_per_month} rows, recall@{k} on the {SHARD_MERGE_COUNT} recent months")
+    print(f"Full rebuild: {full_time:.2f}s, peak RSS {full_rss:.0f}MB")
+    print(f"Current shard rebuild: {shard_time:.2f}s, peak RSS {shard_rss:.0f}MB")
+    print(f"Merged recall: {result['merged_recall']:.3f}, query: {result['query_ms']:.3f}ms")
+    return result
+
+
+if __name__ == '__main__':
+    benchmark_ann()
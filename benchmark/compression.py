@@ -0,0 +1,68 @@
+from time import perf_counter
+from benchmark.serialization import make_article, make_short_article
+from server.compression import CompressionMiddleware, brotli
+from server.response import MongoJSONResponse
+
+
+# (encoding, level / quality)
+COMPRESSION_SETUPS = [
+    ('gzip', 1),
+    ('gzip', 6),
+    ('gzip', 9),
+    ('br', 1),
+    ('br', 5),
+    ('br', 11),
+]
+
+
+def make_bodies():
+    article = make_article(paragraphs=60)
+    recommendations = [make_short_article(i) for i in range(10)]
+    return {
+        '/article/{id}': MongoJSONResponse({"article": article, "recommendations": recommendations}).body,
+        '/articles': MongoJSONResponse([make_short_article(i) for i in range(20)]).body,
+    }
+
+
+def benchmark_compression(repeat=200):
+    """
+    Bytes on wire and compression time of the API responses for every setup,
+    then the time of a cached (hot article) response.
+
+    Returns
+    ----------
+    dict
+        {(endpoint, encoding, level): (compressed size, seconds per response)}
+    """
+
+    results = {}
+    for endpoint, body in make_bodies().items():
+        print(f'\n{endpoint}: {len(body)} B uncompressed')
+        for encoding, level in COMPRESSION_SETUPS:
+            if encoding == 'br' and brotli is None:
+                print(f'{encoding:<5} {level:>2} not installed')
+                continue
+
+            middleware = CompressionMiddleware(None, gzip_level=level, brotli_quality=level)
+            start_time = perf_counter()
+            for _ in range(repeat):
+                compressed_body = middleware.get_compressed_body(body, encoding)
+            executed_time = (perf_counter() - start_time) / repeat
+
+            results[(endpoint, encoding, level)] = (len(compressed_body), executed_time)
+            print(f'{encoding:<5} {level:>2} {len(compressed_body):>7} B ({len(compressed_body) / len(body):6.2%}), '
+                  f'{executed_time * 1e6:8.1f} us')
+
+        middleware = CompressionMiddleware(None)
+        encoding = middleware.encodings[0]
+        middleware.get_compressed_body(body, encoding, '"etag"')
+        start_time = perf_counter()
+        for _ in range(repeat):
+            middleware.get_compressed_body(body, encoding, '"etag"')
+        print(f'cached {encoding}: {(perf_counter() - start_time) / repeat * 1e6:.2f} us')
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_compression()
@@ -0,0 +1,375 @@
+import json
+import os
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+from crawler import fetcher, parser
+from crawler.database.dantri import DantriCrawler
+from crawler.database.vietnamnet import VietnamnetCrawler
+from crawler.database.vnexpress import VnexpressCrawler
+from crawler.database.vtcnews import VtcnewsCrawler
+from benchmark.fixtures import FIXTURE_DIR, load_manifest, save_page
+
+
+CRAWLERS = [VnexpressCrawler, DantriCrawler, VietnamnetCrawler, VtcnewsCrawler]
+
+# listing pages generated by SyntheticListingServer for every crawler:
+# (path of a page, number of the first page, html of an article of the listing)
+LISTING_FORMATS = {
+    'vnexpress': (
+        r'/vnexpress/(?P<category>[\w-]+)-p(?P<page>\d+)/$', 1,
+        '<article><a href="https://vnexpress.net/tin-{id}.html"><img src="https://i.vnecdn.net/{id}.jpg"></a></article>'
+    ),
+    'dantri': (
+        r'/dantri/(?P<category>[\w-]+)/trang-(?P<page>\d+)\.htm$', 1,
+        '<article class="article-item"><a href="/{category}/tin-{id}.htm"><img src="https://cdnphoto.dantri.com.vn/{id}.jpg"></a></article>'
+    ),
+    'vietnamnet': (
+        r'/vietnamnet/(?P<category>[\w-]+)-page(?P<page>\d+)$', 0,
+        '<div class="horizontalPost"><a href="/tin-{id}.html"><img src="https://static-images.vnncdn.net/{id}.jpg"></a></div>'
+    ),
+    'vtcnews': (
+        r'/vtcnews/(?P<category>[\w-]+)/trang-(?P<page>\d+)\.html$', 1,
+        '<article><a href="/tin-ar{id}.html"><img src="https://cdn-i.vtcnews.vn/{id}.jpg"></a></article>'
+    ),
+}
+LISTING_PAGE_SIZE = 20
+
+
+def normalize_article(article: dict):
+    """
+    Make an extracted article comparable with its JSON saved version.
+    """
+
+    return json.loads(json.dumps(article, default=str, sort_keys=True, ensure_ascii=False))
+
+
+def get_expected_path(web: str):
+    return os.path.join(FIXTURE_DIR, web, 'expected.json')
+
+
+def load_expected_articles(web: str) -> dict:
+    try:
+        with open(get_expected_path(web), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def record_crawl(crawler, category: str, links_limit=20):
+    """
+    Crawl a category live, save every listing/article page to the corpus
+    and the extracted articles as the expected output.
+    """
+
+    def recorder(web, kind, url, response):
+        if response.status_code == 200:
+            save_page(web, url, response.content, kind, category)
+
+    fetcher.recorder = recorder
+    try:
+        articles, _ = crawler.crawl_articles(category, links_limit, use_database=False)
+    finally:
+        fetcher.recorder = None
+
+    expected = load_expected_articles(crawler.web_name)
+    expected.update({article['link']: normalize_article(article) for article in articles})
+    with open(get_expected_path(crawler.web_name), 'w', encoding='utf-8') as file:
+        json.dump(expected, file, indent=4, ensure_ascii=False)
+
+
+class FixtureServer:
+    """
+    Local HTTP server replaying the saved pages of every crawler.
+
+    A request to /{web}/{path} serves the page saved for {root_url}/{path}. Every site is served on its own port,
+    so it has its own rate limiter in the fetcher like the real hosts.
+
+    Parameters
+    ----------
+    latency : tuple[float, float]
+        Min and max delay (seconds) added to every response.
+    error_rate : float
+        Probability of answering with error_status instead of the page.
+    drop_rate : float
+        Probability of closing the connection without answering (connection error).
+    rate_limit : bool
+        Keep the rate limiters of the fetcher, False measures the crawler instead of the limiter.
+    """
+
+    def __init__(self, latency=(0.0, 0.0), error_rate=0.0, error_status=503, drop_rate=0.0, seed=0, rate_limit=False):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.previous_rate_limit = fetcher.rate_limit
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pages = {}
+
+        for crawler in CRAWLERS:
+            for page in load_manifest(crawler.web_name):
+                path = os.path.join(FIXTURE_DIR, crawler.web_name, 'pages', page['file'])
+                self.pages[page['url']] = path
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.servers = {crawler.web_name: ThreadingHTTPServer(('127.0.0.1', 0), Handler) for crawler in CRAWLERS}
+        self.urls = {web: f'http://127.0.0.1:{httpd.server_port}' for web, httpd in self.servers.items()}
+        self.threads = [threading.Thread(target=httpd.serve_forever, daemon=True) for httpd in self.servers.values()]
+
+    def get_original_url(self, path: str):
+        web, _, rest = path.lstrip('/').partition('/')
+        for crawler in CRAWLERS:
+            if crawler.web_name == web:
+                return f'{crawler.root_url}/{rest}'
+        return None
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        with self.lock:
+            delay = self.random.uniform(*self.latency)
+            error = self.random.random() < self.error_rate
+            drop = self.random.random() < self.drop_rate
+
+        sleep(delay)
+        if drop:
+            request.close_connection = True
+            request.connection.close()
+            return
+
+        file_path = self.pages.get(self.get_original_url(request.path))
+        if error or file_path is None:
+            request.send_response(self.error_status if error else 404)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        with open(file_path, 'rb') as file:
+            content = file.read()
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/html; charset=utf-8')
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        for crawler in CRAWLERS:
+            fetcher.url_rewrites[crawler.root_url] = f'{self.urls[crawler.web_name]}/{crawler.web_name}'
+        fetcher.rate_limit = self.rate_limit
+        return self
+
+    def __exit__(self, *args):
+        fetcher.rate_limit = self.previous_rate_limit
+        for crawler in CRAWLERS:
+            fetcher.url_rewrites.pop(crawler.root_url, None)
+        for httpd in self.servers.values():
+            httpd.shutdown()
+            httpd.server_close()
+
+
+class SyntheticListingServer:
+    """
+    Local HTTP server of generated listing pages of a crawler, the listings grow every simulated day.
+
+    Every category lists its articles from newest to oldest (LISTING_PAGE_SIZE per page) under a pinned story,
+    the first page answers 304 to a request with the ETag of the current listing.
+    """
+
+    def __init__(self, crawler, categories: list[str], pinned_articles=1):
+        self.crawler = crawler
+        self.path_pattern, self.first_page, self.item_html = LISTING_FORMATS[crawler.web_name]
+        self.next_id = 10 ** 6
+        self.listings = {category: [] for category in categories}
+        self.pinned = {category: [self.new_id() for _ in range(pinned_articles)] for category in categories}
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.previous_rate_limit = fetcher.rate_limit
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def publish(self, category: str, count: int):
+        self.listings[category] = [self.new_id() for _ in range(count)][::-1] + self.listings[category]
+
+    def get_etag(self, category: str):
+        return f'"{category}-{len(self.listings[category])}"'
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        match = re.match(self.path_pattern, request.path)
+        category = match and match['category']
+        if category not in self.listings:
+            request.send_response(404)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        etag = self.get_etag(category)
+        page = int(match['page']) - self.first_page
+        ids = (self.pinned[category] + self.listings[category])[page * LISTING_PAGE_SIZE:(page + 1) * LISTING_PAGE_SIZE]
+        if page == 0 and request.headers.get('If-None-Match') == etag:
+            status, content = 304, b''
+        elif len(ids) == 0:
+            status, content = 404, b''
+        else:
+            items = ''.join(self.item_html.format(id=article_id, category=category) for article_id in ids)
+            status, content = 200, f'<html><body>{items}</body></html>'.encode()
+
+        request.send_response(status)
+        request.send_header('Content-Length', str(len(content)))
+        if page == 0:
+            request.send_header('ETag', etag)
+        request.end_headers()
+        request.wfile.write(content)
+
+    def __enter__(self):
+        self.thread.start()
+        fetcher.url_rewrites[self.crawler.root_url] = f'http://127.0.0.1:{self.httpd.server_port}/{self.crawler.web_name}'
+        fetcher.rate_limit = False
+        return self
+
+    def __exit__(self, *args):
+        fetcher.rate_limit = self.previous_rate_limit
+        fetcher.url_rewrites.pop(self.crawler.root_url, None)
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def benchmark_listing_requests(crawler, days=7, categories=4, max_new_articles=40, seed=0):
+    """
+    Listing requests of the daily updates of a crawler, on generated listings that get 0 to max_new_articles
+    new articles per category and day (a category without new article is unchanged):
+    - before: the listing is walked until a page without new link, every page is requested again.
+    - after: the first page is requested with the validators of the previous crawl (one 304 if unchanged)
+      and the walk stops after fetcher.KNOWN_ARTICLE_STREAK already crawled articles in a row.
+    The database of the crawled articles is simulated by the ids found by the previous updates.
+
+    Returns
+    ----------
+    dict
+        Listing requests of every daily update (the first crawl excluded) and their mean, before and after.
+    """
+
+    rng = random.Random(seed)
+    category_names = crawler.categories[:categories]
+    server = SyntheticListingServer(crawler, category_names)
+    for category in category_names:
+        server.publish(category, 3 * LISTING_PAGE_SIZE)
+
+    stored_ids = {'before': set(), 'after': set()}
+    states = {category: {} for category in category_names}
+    requests = {'before': [], 'after': []}
+    find_known_ids = crawler.find_known_ids
+    crawler.find_known_ids = staticmethod(lambda link_ids: {link_id for link_id in link_ids if link_id in stored_ids['after']})
+    try:
+        with server:
+            for day in range(days + 1):
+                if day > 0:
+                    for category in category_names:
+                        server.publish(category, rng.choice([0, rng.randint(1, max_new_articles)]))
+
+                for policy in ['before', 'after']:
+                    fetcher.reset_request_counter()
+                    for category in category_names:
+                        if policy == 'before':
+                            # the previous crawl only knew the crawled ids
+                            links, _, _ = crawler.crawl_article_links(
+                                category, known_ids=set(stored_ids['before']), use_database=False
+                            )
+                        else:
+                            links, _, states[category] = crawler.crawl_article_links(
+                                category, known_ids=set(), state=states[category]
+                            )
+                        stored_ids[policy].update(crawler.extract_id(link) for link, _ in links)
+
+                    if day > 0:
+                        requests[policy].append(fetcher.request_counter[crawler.web_name]['listing'])
+    finally:
+        crawler.find_known_ids = find_known_ids
+
+    report = {
+        'web': crawler.web_name,
+        'requests_before': requests['before'],
+        'requests_after': requests['after'],
+        'mean_before': sum(requests['before']) / max(days, 1),
+        'mean_after': sum(requests['after']) / max(days, 1),
+        'missed_articles': len(stored_ids['before'] - stored_ids['after']),
+    }
+    print(f"\n{report['web']}: listing requests per daily update ({len(category_names)} categories): "
+          f"before {report['mean_before']:.1f}, after {report['mean_after']:.1f}, "
+          f"missed articles: {report['missed_articles']}")
+    return report
+
+
+def benchmark_crawl(crawler, links_limit=10 ** 9, **server_options):
+    """
+    Run crawl_articles of every recorded category against the fixture server
+    (without the rate limiter unless server_options has rate_limit=True).
+
+    Returns
+    ----------
+    dict
+        Pages per second, parse time per page, number of articles and the links with a different extraction.
+    """
+
+    categories = sorted({page['category'] for page in load_manifest(crawler.web_name) if page['category']})
+    expected = load_expected_articles(crawler.web_name)
+    articles = []
+
+    fetcher.reset_request_counter()
+    parser.reset_parse_stats()
+    with FixtureServer(**server_options):
+        start_time = perf_counter()
+        for category in categories:
+            temp_articles, _ = crawler.crawl_articles(category, links_limit, use_database=False)
+            articles.extend(temp_articles)
+        executed_time = perf_counter() - start_time
+
+    counter = fetcher.request_counter[crawler.web_name]
+    pages = counter['listing'] + counter['article']
+    crawled = {article['link']: normalize_article(article) for article in articles}
+    diffs = [link for link, article in expected.items() if crawled.get(link) != article]
+
+    report = {
+        'web': crawler.web_name,
+        'pages': pages,
+        'pages_per_second': pages / executed_time if executed_time > 0 else 0.0,
+        'parse_ms_per_page': parser.parse_stats['seconds'] / max(parser.parse_stats['pages'], 1) * 1000,
+        'articles': len(articles),
+        'expected_articles': len(expected),
+        'diffs': diffs,
+    }
+
+    print(f"\n{report['web']}: {report['pages']} pages in {executed_time:.2f}s "
+          f"({report['pages_per_second']:.2f} pages/s), parse {report['parse_ms_per_page']:.2f} ms/page")
+    print(f"Articles: {report['articles']} / {report['expected_articles']} expected, different extraction: {len(diffs)}")
+    for link in diffs:
+        print(f'    {link}')
+
+    return report
+
+
+if __name__ == '__main__':
+    for crawler in CRAWLERS:
+        benchmark_crawl(crawler, latency=(0.02, 0.1), error_rate=0.02)
+        benchmark_listing_requests(crawler)
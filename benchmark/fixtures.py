@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import requests
+
+
+FIXTURE_DIR = 'data/fixtures'
+
+
+def get_manifest_path(web: str):
+    return os.path.join(FIXTURE_DIR, web, 'manifest.json')
+
+
+def load_manifest(web: str) -> list[dict]:
+    """
+    Load the list of saved pages of a web.
+
+    Returns
+    ----------
+    list[dict]
+        [{'url': str, 'file': str, 'kind': 'listing' | 'article', 'category': str | None}]
+    """
+
+    try:
+        with open(get_manifest_path(web), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return []
+
+
+def save_manifest(web: str, pages: list[dict]):
+    os.makedirs(os.path.join(FIXTURE_DIR, web, 'pages'), exist_ok=True)
+    with open(get_manifest_path(web), 'w', encoding='utf-8') as file:
+        json.dump(pages, file, indent=4, ensure_ascii=False)
+
+
+def save_page(web: str, url: str, content: bytes, kind: str, category: str = None):
+    """
+    Save the raw content of a page to the corpus of a web (replace the old one if the url exists).
+    """
+
+    file_name = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16] + '.html'
+    os.makedirs(os.path.join(FIXTURE_DIR, web, 'pages'), exist_ok=True)
+    with open(os.path.join(FIXTURE_DIR, web, 'pages', file_name), 'wb') as file:
+        file.write(content)
+
+    pages = [page for page in load_manifest(web) if page['url'] != url]
+    pages.append({'url': url, 'file': file_name, 'kind': kind, 'category': category})
+    save_manifest(web, pages)
+
+
+def record_page(web: str, url: str, kind='article', category: str = None):
+    """
+    Download a live page and add it to the corpus.
+    """
+
+    response = requests.get(url)
+    response.raise_for_status()
+    save_page(web, url, response.content, kind, category)
+
+
+def load_pages(web: str, kind: str = None):
+    """
+    Load the saved pages of a web.
+
+    Returns
+    ----------
+    list[tuple[dict, bytes]]
+        List of (manifest entry, raw content).
+    """
+
+    pages = []
+    for page in load_manifest(web):
+        if kind is not None and page['kind'] != kind:
+            continue
+
+        with open(os.path.join(FIXTURE_DIR, web, 'pages', page['file']), 'rb') as file:
+            pages.append((page, file.read()))
+
+    return pages
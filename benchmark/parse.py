@@ -0,0 +1,72 @@
+from time import perf_counter
+from bs4 import FeatureNotFound
+from crawler.database.dantri import DantriCrawler
+from crawler.database.vietnamnet import VietnamnetCrawler
+from crawler.database.vnexpress import VnexpressCrawler
+from crawler.database.vtcnews import VtcnewsCrawler
+from crawler.parser import parse_html
+from benchmark.fixtures import load_pages
+
+
+# (parser backend, only parse the content containers)
+PARSER_SETUPS = [
+    ('html.parser', False),
+    ('html.parser', True),
+    ('lxml', False),
+    ('lxml', True),
+]
+
+
+def extract(crawler, link: str, content: bytes, features: str, strained: bool):
+    """
+    Parse and extract one page, exceptions are returned as text so they can be compared.
+    """
+
+    strainer = crawler.content_strainer if strained else None
+    soup = parse_html(content, strainer, features)
+    try:
+        return crawler.extract_article_content(link, soup)
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+
+
+def benchmark_parsing(crawler, repeat=3):
+    """
+    Time parse + extract of the saved article pages for every parser setup
+    and compare the output with the original html.parser path.
+
+    Returns
+    ----------
+    dict
+        {(features, strained): (seconds per page, list of links with a different output)}
+    """
+
+    pages = load_pages(crawler.web_name, 'article')
+    results = {}
+    print(f'\n{crawler.web_name}: {len(pages)} article pages')
+    if len(pages) == 0:
+        return results
+
+    baseline = [extract(crawler, page['url'], content, 'html.parser', False) for page, content in pages]
+    for features, strained in PARSER_SETUPS:
+        try:
+            start_time = perf_counter()
+            for _ in range(repeat):
+                outputs = [extract(crawler, page['url'], content, features, strained) for page, content in pages]
+            executed_time = (perf_counter() - start_time) / (repeat * len(pages))
+        except FeatureNotFound:
+            print(f'{features:<12} strained={strained!s:<5} not installed')
+            continue
+
+        diffs = [page['url'] for (page, _), output, expected in zip(pages, outputs, baseline) if output != expected]
+        results[(features, strained)] = (executed_time, diffs)
+        print(f'{features:<12} strained={strained!s:<5} {executed_time * 1000:8.2f} ms/page, different output: {len(diffs)}')
+        for link in diffs:
+            print(f'    {link}')
+
+    return results
+
+
+if __name__ == '__main__':
+    for crawler in [VnexpressCrawler, DantriCrawler, VietnamnetCrawler, VtcnewsCrawler]:
+        benchmark_parsing(crawler)
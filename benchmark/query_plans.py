@@ -0,0 +1,105 @@
+from server.data import connect_to_mongo, get_published_generation, get_published_query
+from server.indexes import ensure_indexes
+from server.queries import (
+    find, get_article_query, get_articles_query, get_batch_recommendation_query, get_listing_query,
+    get_recommendation_query, make_query
+)
+from server.ranking import RERANK_OVERFETCH
+
+
+def get_serving_queries(db, limit=10):
+    """
+    Queries sent by the API (built by server.queries like the endpoints) and the crawlers,
+    with sample values taken from the database.
+
+    Returns
+    ----------
+    list[tuple[str, dict, bool]]
+        (name, query, covered), covered means the index must contain every returned field (no FETCH stage).
+    """
+
+    generation = get_published_generation(db)
+    article = db['newspaper'].find_one(get_published_query(generation), {"category": 1, "web": 1, "link_id": 1})
+    if article is None:
+        return []
+
+    article_ids = [doc['_id'] for doc in db['newspaper'].find(get_published_query(generation), {"_id": 1}).limit(limit)]
+    candidate_count = limit * RERANK_OVERFETCH
+    return [
+        ('articles of the latest category', get_listing_query(generation), False),
+        ('articles of a category', get_listing_query(generation, article['category'], page=2), False),
+        ('article by id', get_article_query(article['_id']), False),
+        ('recommendations of an article', get_recommendation_query(article['_id'], generation, candidate_count), False),
+        ('recommendations of a batch', get_batch_recommendation_query(article_ids, generation, candidate_count), False),
+        ('articles of a batch', get_articles_query(article_ids, detail=True), False),
+        ('recommended articles', get_articles_query(article_ids), False),
+        (
+            'existing link ids',
+            make_query(
+                'newspaper', {"web": article['web'], "link_id": {"$in": [article.get('link_id')]}},
+                {"link_id": 1, "_id": 0}
+            ),
+            True
+        ),
+    ]
+
+
+def get_plan_stages(plan: dict):
+    """
+    Names of every stage of a winning plan (classic and slot based engine).
+    """
+
+    stages = [plan.get('stage')]
+    for key in ['inputStage', 'queryPlan']:
+        if key in plan:
+            stages.extend(get_plan_stages(plan[key]))
+    for child in plan.get('inputStages', []):
+        stages.extend(get_plan_stages(child))
+
+    return [stage for stage in stages if stage is not None]
+
+
+def explain_query(db, query: dict):
+    return get_plan_stages(find(db, query).explain()['queryPlanner']['winningPlan'])
+
+
+def check_query_plans():
+    """
+    Explain every serving query against the database: it must use an index (no COLLSCAN),
+    sort with the index (no SORT stage) and, for the covered ones, not fetch the documents.
+
+    The keyword search (unanchored regex on title/description) can't use an index and isn't checked.
+
+    Returns
+    ----------
+    list[str]
+        Names of the queries without a proper index.
+    """
+
+    with connect_to_mongo() as client:
+        db = client['Ganesha_News']
+        ensure_indexes(db)
+
+        failed_queries = []
+        for name, query, covered in get_serving_queries(db):
+            stages = explain_query(db, query)
+            uses_index = any(stage in ['IXSCAN', 'IDHACK', 'EXPRESS_IXSCAN', 'COUNT_SCAN'] for stage in stages)
+            problems = []
+            if 'COLLSCAN' in stages or not uses_index:
+                problems.append('COLLSCAN')
+            if 'SORT' in stages:
+                problems.append('in memory SORT')
+            if covered and 'FETCH' in stages:
+                problems.append('not covered')
+
+            print(f"{name}: {' <- '.join(stages)}{' -> ' + ', '.join(problems) if problems else ''}")
+            if len(problems) > 0:
+                failed_queries.append(name)
+
+    return failed_queries
+
+
+if __name__ == '__main__':
+    failed_queries = check_query_plans()
+    if len(failed_queries) > 0:
+        raise SystemExit(f'Queries without a proper index: {failed_queries}')
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+from time import perf_counter
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from fastapi.utils import create_model_field
+from server.model import Article, ArticleRecommendation, ShortArticle, SearchResponse
+from server.response import MongoJSONResponse
+
+
+def make_short_article(i: int):
+    return {
+        "_id": ObjectId(),
+        "title": f"Giá vàng hôm nay {i}: tăng mạnh sau phiên giảm sâu, nhà đầu tư chốt lời",
+        "description": "Sáng nay, giá vàng miếng trong nước tiếp tục tăng theo đà của thị trường thế giới, "
+                       "chênh lệch giữa giá mua và bán được các doanh nghiệp nới rộng. " * 2,
+        "thumbnail": f"https://i1-kinhdoanh.vnecdn.net/2024/01/01/vang-{i}.jpg",
+    }
+
+
+def make_article(paragraphs=40):
+    content = []
+    for i in range(paragraphs):
+        if i % 8 == 0:
+            content.append([f"IMAGECONTENT:https://i1-kinhdoanh.vnecdn.net/2024/01/01/anh-{i}.jpg", "Ảnh minh họa"])
+        else:
+            content.append("Theo các chuyên gia, thị trường sẽ còn biến động trong thời gian tới khi lãi suất "
+                           "và tỷ giá chịu nhiều áp lực từ bên ngoài, người dân cần thận trọng khi mua vào. " * 2)
+
+    return {
+        **make_short_article(0),
+        "category": "kinh-doanh",
+        "published_date": datetime(2024, 1, 1) + timedelta(hours=7),
+        "content": content,
+    }
+
+
+def encode_with_models(response_model, content):
+    """
+    Previous path: build the models then FastAPI validates and serializes them again (response_model).
+    """
+
+    field = create_model_field(name="Response", type_=response_model, mode="serialization")
+
+    def encode():
+        value, errors = field.validate(content(), {}, loc=("response",))
+        if errors:
+            raise ValueError(errors)
+        return JSONResponse(field.serialize(value, mode="json", by_alias=True)).body
+
+    return encode
+
+
+def time_function(function, repeat: int):
+    function()
+    start_time = perf_counter()
+    for _ in range(repeat):
+        body = function()
+    return (perf_counter() - start_time) / repeat, len(body)
+
+
+def benchmark_serialization(page_size=20, recommendations=10, repeat=2000):
+    """
+    Time the encoding of an /articles page, an /article response and a /search page
+    with the models (previous path) and with the direct orjson encoding of the documents.
+
+    Returns
+    ----------
+    dict
+        {endpoint: {'models': seconds per response, 'direct': seconds per response}}
+    """
+
+    page = [make_short_article(i) for i in range(page_size)]
+    article = make_article()
+    recommendation_list = [make_short_article(i) for i in range(recommendations)]
+
+    cases = {
+        '/articles': (
+            encode_with_models(list[ShortArticle], lambda: [ShortArticle(**doc) for doc in page]),
+            lambda: MongoJSONResponse(page).body,
+        ),
+        '/article/{id}': (
+            encode_with_models(ArticleRecommendation, lambda: ArticleRecommendation(
+                article=Article(**article),
+                recommendations=[ShortArticle(**doc) for doc in recommendation_list]
+            )),
+            lambda: MongoJSONResponse({"article": article, "recommendations": recommendation_list}).body,
+        ),
+        '/search': (
+            encode_with_models(SearchResponse, lambda: SearchResponse(
+                articles=[ShortArticle(**doc) for doc in page], total=page_size
+            )),
+            lambda: MongoJSONResponse({"articles": page, "total": page_size}).body,
+        ),
+    }
+
+    results = {}
+    for endpoint, (models, direct) in cases.items():
+        models_time, models_size = time_function(models, repeat)
+        direct_time, direct_size = time_function(direct, repeat)
+        results[endpoint] = {'models': models_time, 'direct': direct_time}
+        print(f'{endpoint:<15} models {models_time * 1e6:8.1f} us ({models_size} B), '
+              f'direct {direct_time * 1e6:8.1f} us ({direct_size} B), x{models_time / direct_time:.1f}')
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_serialization()
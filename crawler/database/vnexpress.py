@@ -4,8 +4,12 @@ from bs4 import BeautifulSoup
 from bs4.element import Tag
 import requests
 from datetime import datetime
-from time import sleep
-from server.data import connect_to_mongo
+from server.data import (
+    connect_to_mongo, find_existing_link_ids, load_crawl_state, save_crawl_state,
+    add_to_frontier, get_pending_links, mark_frontier_done, mark_frontier_failed
+)
+from crawler import fetcher
+from crawler.parser import make_strainer, parse_html
 
 
 class VnexpressCrawler:
@@ -16,6 +20,12 @@ class VnexpressCrawler:
         'giai-tri', 'the-thao', 'giao-duc', 'suc-khoe',
         'du-lich', 'oto-xe-may', 'khoa-hoc', 'so-hoa'
     ]
+    # containers used by the extraction, the rest of the page is not parsed
+    content_strainer = make_strainer(
+        ('h1', 'title-detail'), ('p', 'description'), ('span', 'date'),
+        ('div', 'date-new'), ('article', 'fck_detail')
+    )
+    listing_strainer = make_strainer(('article', None))
 
     @staticmethod
     def get_category_name(category: str):
@@ -102,52 +112,117 @@ class VnexpressCrawler:
         else:
             return article_id
 
+    @staticmethod
+    def find_known_ids(link_ids: list[str]):
+        """
+        Check a batch of article ids against the (web, link_id) index of the database and the black list.
+
+        Returns
+        ----------
+        set
+            Set of ids that already exist.
+        """
+
+        return find_existing_link_ids(VnexpressCrawler.web_name, link_ids)
+
+    @staticmethod
+    def get_black_list_document(link: str):
+        return {"link": link, "web": VnexpressCrawler.web_name, "link_id": VnexpressCrawler.extract_id(link)}
+
 
     @staticmethod
-    def crawl_article_links(category: str, max_page=20, limit=10 ** 9):
+    def crawl_article_links(category: str, max_page=20, limit=10 ** 9, known_ids: set = None, state: dict = None, use_database=True):
         """
         Crawl all article link for a specific category.
 
+        known_ids is the set of article ids already seen in this run, it is shared between categories
+        and filled with the ids found in the database index.
+
+        state is the high-water mark of the previous crawl: the first page is requested conditionally
+        with its ETag/Last-Modified and the search stops after fetcher.KNOWN_ARTICLE_STREAK already crawled articles in a row.
+
+        use_database=False skips the database checks (offline benchmark).
+
         Returns
         ----------
         tuple
             A tuple containing:
             - List of (link, thumbnail_link)
             - Set of black links (links that can't be crawled)
+            - The new state of the category
         """
 
         print(f'Crawl links for category: {category}/{VnexpressCrawler.web_name}')
-        article_link_ids = VnexpressCrawler.get_all_links()
-        article_black_list_ids = VnexpressCrawler.get_all_black_links()
+        if known_ids is None:
+            known_ids = set()
+        if state is None:
+            state = {}
+        new_state = dict(state)
 
         link_and_thumbnails = []
         black_list = set()
+        fail_list = []
         page_num = 1
 
         # vnexpress has maximum 20 page
         max_page = min(max_page, 20)
         founded_links = 0
+        known_streak = 0
         while page_num <= max_page and founded_links < limit:
-            sleep(0.1)
             found_new_link = False
+            reached_known_article = False
             url = f'{VnexpressCrawler.root_url}/{category}-p{page_num}/'
+            first_page = page_num == 1
             page_num += 1
 
             try:
-                response = requests.get(url)
-                soup = BeautifulSoup(response.content, 'html.parser')
+                # only the first page is requested conditionally
+                response = fetcher.get_listing_page(url, VnexpressCrawler.web_name, state if first_page else None)
+                if response.status_code == 304:
+                    print(f"\nCategory has not changed since the last crawl!")
+                    break
+
+                # no more page
+                if response.status_code == 404:
+                    break
+                response.raise_for_status()
+
+                if first_page:
+                    new_state.update(fetcher.get_validators(response))
+
+                soup = parse_html(response.content, VnexpressCrawler.listing_strainer)
 
                 # find all the link
-                article_tags = soup.find_all('article')
-                for article_tag in article_tags:
+                candidates = []
+                for article_tag in soup.find_all('article'):
                     a_tag = article_tag.find('a')
                     article_link = a_tag['href']
-                    img_tag = article_tag.find('img')
                     article_id = VnexpressCrawler.extract_id(article_link)
+                    candidates.append((article_link, article_id, article_tag.find('img')))
+
+                # check the whole page against the database in one query
+                existing_ids = set()
+                if use_database:
+                    existing_ids = VnexpressCrawler.find_known_ids(
+                        [article_id for _, article_id, _ in candidates if article_id not in known_ids]
+                    )
+                known_ids.update(existing_ids)
+                if first_page and len(candidates) > 0:
+                    new_state['latest_id'] = candidates[0][1]
+
+                for article_link, article_id, img_tag in candidates:
+                    # articles are listed from newest to oldest -> the rest was crawled before (pinned stories aside)
+                    known_streak = fetcher.count_known_articles(known_streak, article_id, existing_ids, state)
+                    if known_streak >= fetcher.KNOWN_ARTICLE_STREAK:
+                        reached_known_article = True
+                        break
+                    if known_streak > 0:
+                        continue
 
                     # no img tag mean no thumbnail -> skip
                     if img_tag is None:
-                        if article_id not in article_black_list_ids:
+                        if article_id not in known_ids:
+                            known_ids.add(article_id)
                             black_list.add(article_link)
                         continue
 
@@ -159,25 +234,42 @@ class VnexpressCrawler:
                         image_link = img_tag['data-src']
 
                     # check for duplicated and "black" link
-                    if article_id not in article_link_ids and article_id not in article_black_list_ids:
+                    if article_id not in known_ids:
                         found_new_link = True
                         founded_links += 1
-                        article_link_ids.add(article_id)
+                        known_ids.add(article_id)
                         link_and_thumbnails.append((article_link, image_link))
 
                     if founded_links >= limit:
                         print(f"\nFounded links passed the {limit} limit, terminate the searching!")
                         break
                         
+                if reached_known_article:
+                    print(f"\nReach the last crawled article, terminate the searching!")
+                    break
+
                 if not found_new_link:
                     print(f"\nNo new link found, terminate the searching!")
                     break
 
             except Exception as e:
-                pass
+                print(f"\nFail to crawl links from {url}: {e}")
+                fail_list.append((url, e))
 
         print(f"\nFind {len(link_and_thumbnails)} links")
-        return link_and_thumbnails, black_list
+
+        # log the listing pages that couldn't be crawled and walk them again next time,
+        # also when the limit stopped the walk (a 304 next time would skip the pages left)
+        if len(fail_list) > 0 or founded_links >= limit:
+            new_state['etag'] = state.get('etag')
+            new_state['last_modified'] = state.get('last_modified')
+
+        error_log_dir = f'error_log/{VnexpressCrawler.web_name}'
+        os.makedirs(error_log_dir, exist_ok=True)
+        with open(f'{error_log_dir}/listing-error-{category}.txt', 'w') as file:
+            file.writelines([f'Link: {item[0]} ;; Exception: {str(item[1])}\n' for item in fail_list])
+
+        return link_and_thumbnails, black_list, new_state
 
     @staticmethod
     def crawl_article_content(link: str):
@@ -194,136 +286,189 @@ class VnexpressCrawler:
         """
 
         try:
-            response = requests.get(link)
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            content_list = []
-            h1_title = soup.find('h1', class_='title-detail')
-            p_description = soup.find('p', class_='description')
-            span_place = p_description.find('span', class_='location-stamp')
-            span_date = soup.find('span', class_='date')
-
-            # some article have different tag for date info
-            if span_date is None:
-                span_date = soup.find('div', class_='date-new')
-
-            # remove Place Text
-            description = p_description.get_text()
-            if span_place is not None:
-                description = description.removeprefix(span_place.get_text())
-
-            # extract date info
-            span_date_info = span_date.get_text().split(',')
-            date_str = span_date_info[1].strip()
-            time_str = span_date_info[2].strip()[:5]
-            published_date = datetime.strptime(date_str + ' ' + time_str, '%d/%m/%Y %H:%M')
-
-            # loop through all content, only keep p (text) and figure(img)
-            article_content = soup.find('article', class_='fck_detail')
-            for element in article_content:
-                if not isinstance(element, Tag):
-                    continue
-
-                # skip video content
-                if element.find('video') is not None:
-                    continue
+            response = fetcher.get(link, VnexpressCrawler.web_name)
+            soup = parse_html(response.content, VnexpressCrawler.content_strainer)
+            return VnexpressCrawler.extract_article_content(link, soup)
 
-                # only select p tag with 1 attr -> article text content
-                if element.name == 'p' and len(element.attrs) == 1 and element.get('class', [''])[0] == 'Normal':
-                    content_list.append(element.get_text())
-
-                # image content
-                elif element.name == 'figure':
-                    # extract image link and caption
-                    img_tag = element.find('img')
-
-                    # some figure tag empty (the figure tag at the end of article)
-                    if img_tag is None:
-                        continue
-
-                    image_link = None
-                    if img_tag.get('src', '').startswith('http'):
-                        image_link = img_tag['src']
-                    elif img_tag.get('data-src', '').startswith('http'):
-                        image_link = img_tag['data-src']
+        except Exception as e:
+            return (link, e)
 
-                    p_caption = element.find('p', class_='Image')
-                    caption = ''
-                    if p_caption is not None:
-                        caption = p_caption.get_text()
+    @staticmethod
+    def extract_article_content(link: str, soup: BeautifulSoup):
+        """
+        Extract the article content from a parsed page.
 
-                    img_content = f'IMAGECONTENT:{image_link};;{caption}'
-                    content_list.append(img_content)
+        Returns
+        ----------
+        Article
+            The extracted article content.
 
-                # for image article (different article structure)
-                elif element.name == 'div' and 'item_slide_show' in element.get('class', []):
-                    # extract image link
-                    img_tag = element.find('img')
-                    image_link = None
-                    if img_tag.get('src', '').startswith('http'):
-                        image_link = img_tag['src']
-                    elif img_tag.get('data-src', '').startswith('http'):
-                        image_link = img_tag['data-src']
+        Raises
+        ----------
+        Exception
+            If the page has no supported article content.
+        """
 
-                    img_content = f'IMAGECONTENT:{image_link};;'
-                    content_list.append(img_content)
-
-                    # extract text content for image
-                    div_caption = element.find('div', class_='desc_cation')
-                    for p_tag in div_caption.find_all('p', class_='Normal'):
-                        content_list.append(p_tag.get_text())
-
-            # content list <= 3 -> crawling process is broken, q/a article ...
-            if len(content_list) > 3:
-                return {
-                    'link': link,
-                    'category': '',
-                    'published_date': published_date,
-                    'thumbnail': '',
-                    'title': h1_title.get_text().strip(),
-                    'description': description.strip(),
-                    'content': content_list,
-                    'web': VnexpressCrawler.web_name,
-                    'index': -1
-                }
-            else:
-                raise Exception('NO CONTENT')
+        content_list = []
+        h1_title = soup.find('h1', class_='title-detail')
+        p_description = soup.find('p', class_='description')
+        span_place = p_description.find('span', class_='location-stamp')
+        span_date = soup.find('span', class_='date')
+
+        # some article have different tag for date info
+        if span_date is None:
+            span_date = soup.find('div', class_='date-new')
+
+        # remove Place Text
+        description = p_description.get_text()
+        if span_place is not None:
+            description = description.removeprefix(span_place.get_text())
+
+        # extract date info
+        span_date_info = span_date.get_text().split(',')
+        date_str = span_date_info[1].strip()
+        time_str = span_date_info[2].strip()[:5]
+        published_date = datetime.strptime(date_str + ' ' + time_str, '%d/%m/%Y %H:%M')
+
+        # loop through all content, only keep p (text) and figure(img)
+        article_content = soup.find('article', class_='fck_detail')
+        for element in article_content:
+            if not isinstance(element, Tag):
+                continue
+
+            # skip video content
+            if element.find('video') is not None:
+                continue
+
+            # only select p tag with 1 attr -> article text content
+            if element.name == 'p' and len(element.attrs) == 1 and element.get('class', [''])[0] == 'Normal':
+                content_list.append(element.get_text())
+
+            # image content
+            elif element.name == 'figure':
+                # extract image link and caption
+                img_tag = element.find('img')
+
+                # some figure tag empty (the figure tag at the end of article)
+                if img_tag is None:
+                    continue
 
-        except Exception as e:
-            return (link, e)
+                image_link = None
+                if img_tag.get('src', '').startswith('http'):
+                    image_link = img_tag['src']
+                elif img_tag.get('data-src', '').startswith('http'):
+                    image_link = img_tag['data-src']
+
+                p_caption = element.find('p', class_='Image')
+                caption = ''
+                if p_caption is not None:
+                    caption = p_caption.get_text()
+
+                img_content = f'IMAGECONTENT:{image_link};;{caption}'
+                content_list.append(img_content)
+
+            # for image article (different article structure)
+            elif element.name == 'div' and 'item_slide_show' in element.get('class', []):
+                # extract image link
+                img_tag = element.find('img')
+                image_link = None
+                if img_tag.get('src', '').startswith('http'):
+                    image_link = img_tag['src']
+                elif img_tag.get('data-src', '').startswith('http'):
+                    image_link = img_tag['data-src']
+
+                img_content = f'IMAGECONTENT:{image_link};;'
+                content_list.append(img_content)
+
+                # extract text content for image
+                div_caption = element.find('div', class_='desc_cation')
+                for p_tag in div_caption.find_all('p', class_='Normal'):
+                    content_list.append(p_tag.get_text())
+
+        # content list <= 3 -> crawling process is broken, q/a article ...
+        if len(content_list) > 3:
+            return {
+                'link': link,
+                'category': '',
+                'published_date': published_date,
+                'thumbnail': '',
+                'title': h1_title.get_text().strip(),
+                'description': description.strip(),
+                'content': content_list,
+                'web': VnexpressCrawler.web_name,
+                'link_id': VnexpressCrawler.extract_id(link),
+                'index': -1
+            }
+        else:
+            raise Exception('NO CONTENT')
 
     @staticmethod
-    def crawl_articles(category: str, links_limit=10 ** 9):
+    def iter_articles(category: str, links_limit=10 ** 9, known_ids: set = None, use_database=True, run_id: str = None):
         """
         Crawl all articles for the given category and log all errors.
 
-        Returns
+        With the database, the found links are added to the crawl frontier and the articles are crawled
+        from the pending links of the frontier (also the ones left by an interrupted run).
+        If the listing was already walked during the run run_id, only the frontier is crawled.
+
+        Articles are yielded as soon as they are crawled, the crawl states must only be saved
+        once everything yielded before them has been stored.
+
+        Yields
         ----------
         tuple
-            - list: List of articles.
-            - set: Set of blacklisted links (links that couldn't be crawled).
+            - ('article', dict): A crawled article.
+            - ('black_list', dict): A black list document (link that couldn't be crawled).
+            - ('checkpoint', dict): The new crawl state of the category.
         """
 
         fail_attempt = 0
-        articles = []
-        article_links, black_list = VnexpressCrawler.crawl_article_links(category, limit=links_limit)
+        published_dates = []
         fail_list = []
-        print(f'Crawl articles for category: {category}')
+        state = load_crawl_state(VnexpressCrawler.web_name, category) if use_database else {}
 
+        if run_id is not None and state.get('listed_run') == run_id:
+            print(f'Links for category: {category}/{VnexpressCrawler.web_name} were already crawled in this run')
+        else:
+            article_links, black_list, new_state = VnexpressCrawler.crawl_article_links(
+                category, limit=links_limit, known_ids=known_ids, state=state, use_database=use_database
+            )
+            for link in black_list:
+                yield 'black_list', VnexpressCrawler.get_black_list_document(link)
+
+            if use_database:
+                add_to_frontier(VnexpressCrawler.web_name, category, [
+                    (VnexpressCrawler.extract_id(link), link, thumbnail) for link, thumbnail in article_links
+                ])
+                state = {**new_state, 'listed_run': run_id}
+                yield 'checkpoint', {**state, 'web': VnexpressCrawler.web_name, 'category': category}
+
+        # crawl the pending links, skip the ones already stored before an interruption
+        if use_database:
+            pending_links = get_pending_links(VnexpressCrawler.web_name, category, links_limit)
+            existing_ids = VnexpressCrawler.find_known_ids([doc['link_id'] for doc in pending_links])
+            mark_frontier_done(VnexpressCrawler.web_name, existing_ids)
+            article_links = [
+                (doc['link'], doc['thumbnail']) for doc in pending_links if doc['link_id'] not in existing_ids
+            ]
+
+        print(f'Crawl articles for category: {category}')
         for index, (link, thumbnail) in enumerate(article_links):
-            sleep(0.2)
             article = VnexpressCrawler.crawl_article_content(link)
             if isinstance(article, dict):
                 article['thumbnail'] = thumbnail
                 article['category'] = VnexpressCrawler.get_category_name(category)
-                articles.append(article)
+                published_dates.append(article['published_date'])
+                yield 'article', article
             else:
                 fail_attempt += 1
                 fail_list.append(article)
 
-                # add the link to black list except for Connection issue
+                # add the link to black list except for Connection issue (retried by the next runs)
                 if not isinstance(article[1], requests.RequestException):
-                    black_list.add(link)
+                    yield 'black_list', VnexpressCrawler.get_black_list_document(link)
+                elif use_database:
+                    mark_frontier_failed(VnexpressCrawler.web_name, VnexpressCrawler.extract_id(link), str(article[1]))
 
         print(f'\nSuccess: {len(article_links) - fail_attempt}, Fail: {fail_attempt}\n')
 
@@ -335,6 +480,36 @@ class VnexpressCrawler:
         with open(error_file_path, 'w') as file:
             file.writelines([f'Link: {item[0]} ;; Exception: {str(item[1])}\n' for item in fail_list])
 
+        # update the high-water mark
+        if state.get('latest_published_date') is not None:
+            published_dates.append(state['latest_published_date'])
+        if len(published_dates) > 0:
+            state = {**state, 'latest_published_date': max(published_dates)}
+
+        yield 'checkpoint', {**state, 'web': VnexpressCrawler.web_name, 'category': category}
+
+    @staticmethod
+    def crawl_articles(category: str, links_limit=10 ** 9, known_ids: set = None, use_database=True, run_id: str = None):
+        """
+        Crawl all articles for the given category and log all errors.
+
+        Returns
+        ----------
+        tuple
+            - list: List of articles.
+            - set: Set of blacklisted links (links that couldn't be crawled).
+        """
+
+        articles = []
+        black_list = set()
+        for kind, document in VnexpressCrawler.iter_articles(category, links_limit, known_ids, use_database, run_id):
+            if kind == 'article':
+                articles.append(document)
+            elif kind == 'black_list':
+                black_list.add(document['link'])
+            elif use_database:
+                save_crawl_state(VnexpressCrawler.web_name, category, document)
+
         return articles, black_list
 
 
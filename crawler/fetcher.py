@@ -0,0 +1,277 @@
+from collections import Counter, defaultdict
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from threading import Lock
+from time import monotonic, sleep
+from urllib.parse import urlparse
+import random
+import requests
+
+
+# number of requests sent per web, split by listing/article/not_modified/retry,
+# with the failed requests (error) and the received bytes
+request_counter = defaultdict(Counter)
+
+# {original root url: replacement root url}, used to redirect the crawlers to a local fixture server
+url_rewrites = {}
+
+# callable(web, kind, url, response) called after every request, used to record fixtures
+recorder = None
+
+# False sends the requests without waiting for the rate limiter of the host, used by the benchmarks
+# against the local fixture server (the crawler is measured instead of the limiter)
+rate_limit = True
+
+TIMEOUT = (10, 30)
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+THROTTLE_STATUS = {429, 503}
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# consecutive already crawled articles of a listing (newest first) before the rest of it is considered crawled,
+# a pinned or top story crawled before doesn't hide the new articles listed below it
+KNOWN_ARTICLE_STREAK = 5
+
+
+class RateLimiter:
+    """
+    Token bucket of one host, the rate adapts to the server:
+    additive increase while the responses are fast and successful,
+    multiplicative decrease on slow responses, errors and 429/503 (which also honor Retry-After).
+    """
+
+    def __init__(self, rate=5.0, min_rate=0.5, max_rate=20.0, increase=0.25, slow_factor=2.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.slow_factor = slow_factor
+        self.tokens = 1.0
+        self.updated_at = monotonic()
+        self.blocked_until = 0.0
+        self.latency = None
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        Wait until a request can be sent.
+        """
+
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(1.0, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            # the token is taken now, the caller waits for the time it takes to refill
+            self.tokens -= 1.0
+            wait_time = max(-self.tokens / self.rate, self.blocked_until - now, 0.0)
+
+        if wait_time > 0:
+            sleep(wait_time)
+
+    def on_response(self, status_code: int, latency: float, retry_after: float = None):
+        with self.lock:
+            if status_code in THROTTLE_STATUS:
+                self.rate = max(self.min_rate, self.rate / 2)
+                if retry_after is not None:
+                    self.blocked_until = max(self.blocked_until, monotonic() + retry_after)
+                return
+
+            # average latency of the host, a response much slower than it means the server is struggling
+            if self.latency is None:
+                self.latency = latency
+            slow = latency > self.slow_factor * self.latency
+            self.latency = 0.8 * self.latency + 0.2 * latency
+
+            if slow or status_code >= 500:
+                self.rate = max(self.min_rate, self.rate * 0.75)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_error(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+
+limiters = {}
+limiters_lock = Lock()
+
+
+def get_limiter(url: str):
+    host = urlparse(url).netloc
+    with limiters_lock:
+        if host not in limiters:
+            limiters[host] = RateLimiter()
+        return limiters[host]
+
+
+def parse_retry_after(value: str):
+    """
+    Retry-After is either a number of seconds or a HTTP date.
+    """
+
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff_time(attempt: int):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def get(url: str, web: str, kind='article', headers: dict = None):
+    """
+    Send a GET request through the rate limiter of the host and count it for the request report.
+
+    Connection errors, timeouts and 429/5xx responses are retried with exponential backoff
+    (up to MAX_RETRIES times).
+
+    Parameters
+    ----------
+    url : str
+        Requested url.
+    web : str
+        Web name of the crawler.
+    kind : str
+        'listing' or 'article'.
+    headers : dict
+        Extra request headers.
+
+    Returns
+    ----------
+    requests.Response
+
+    Raises
+    ----------
+    requests.RequestException
+        If the last attempt failed without response or with a 429/5xx status.
+    """
+
+    for root_url, replacement in url_rewrites.items():
+        if url.startswith(root_url):
+            url = replacement + url.removeprefix(root_url)
+            break
+
+    limiter = get_limiter(url)
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt > 0:
+            request_counter[web]['retry'] += 1
+
+        if rate_limit:
+            limiter.acquire()
+        start_time = monotonic()
+        try:
+            response = requests.get(url, headers=headers, timeout=TIMEOUT)
+        except TRANSIENT_ERRORS:
+            limiter.on_error()
+            if attempt == MAX_RETRIES:
+                request_counter[web]['error'] += 1
+                raise
+            sleep(get_backoff_time(attempt))
+            continue
+
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        limiter.on_response(response.status_code, monotonic() - start_time, retry_after)
+        if response.status_code in RETRY_STATUS and attempt < MAX_RETRIES:
+            sleep(max(retry_after or 0.0, get_backoff_time(attempt)))
+            continue
+        break
+
+    request_counter[web][kind] += 1
+    request_counter[web]['bytes'] += len(response.content)
+    if response.status_code >= 400:
+        request_counter[web]['error'] += 1
+    if response.status_code == 304:
+        request_counter[web]['not_modified'] += 1
+
+    if recorder is not None:
+        recorder(web, kind, url, response)
+
+    # the server is still overloaded after all retries -> connection issue, not a broken page
+    if response.status_code in RETRY_STATUS:
+        response.raise_for_status()
+
+    return response
+
+
+def get_listing_page(url: str, web: str, state: dict = None):
+    """
+    Request a listing page, conditionally if the state has validators of the previous crawl.
+
+    Returns
+    ----------
+    requests.Response
+        The response, status 304 means the listing has not changed.
+    """
+
+    headers = {}
+    if state is not None:
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+
+    return get(url, web, 'listing', headers)
+
+
+def get_validators(response: requests.Response):
+    """
+    Extract the cache validators of a listing page for the next conditional request.
+    """
+
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+
+
+def count_known_articles(streak: int, article_id: str, existing_ids: set, state: dict):
+    """
+    Count the consecutive already crawled articles of a listing: in the database or the latest article
+    of the previous crawl of the category.
+
+    Returns
+    ----------
+    int
+        The new count (0 if the article is new), the listing is crawled up to here once it reaches KNOWN_ARTICLE_STREAK.
+    """
+
+    if article_id in existing_ids or article_id == state.get('latest_id'):
+        return streak + 1
+    return 0
+
+
+def reset_request_counter():
+    request_counter.clear()
+
+
+def report_requests():
+    """
+    Print the number of requests sent per web since the last reset.
+
+    Returns
+    ----------
+    dict
+        {web: {'listing': int, 'article': int, 'not_modified': int, 'retry': int, 'error': int, 'bytes': int}}
+    """
+
+    report = {}
+    print('Requests per web (listing / not modified / article / retry / error / total, MB received)')
+    for web, counter in request_counter.items():
+        total = counter['listing'] + counter['article'] + counter['retry']
+        print(f"{web}: {counter['listing']} / {counter['not_modified']} / {counter['article']} / {counter['retry']} / "
+              f"{counter['error']} / {total}, {counter['bytes'] / 2 ** 20:.1f} MB")
+        report[web] = dict(counter)
+
+    return report
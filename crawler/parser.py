@@ -0,0 +1,73 @@
+import os
+from time import perf_counter
+from bs4 import BeautifulSoup, SoupStrainer
+
+
+def get_default_features():
+    """
+    The built-in html.parser, lxml is much faster but doesn't build the same tree on the malformed pages
+    (a block tag inside a <p> closes it and drops the rest of the paragraph), set the HTML_PARSER
+    environment variable to lxml once its output was checked against html.parser (benchmark/parse.py).
+    """
+
+    return os.getenv('HTML_PARSER') or 'html.parser'
+
+
+DEFAULT_FEATURES = get_default_features()
+
+# number of parsed pages and total parse time, read by the benchmarks
+parse_stats = {'pages': 0, 'seconds': 0.0}
+
+
+def has_class(attrs: dict, class_name: str):
+    classes = attrs.get('class', '')
+    if isinstance(classes, str):
+        classes = classes.split()
+    return class_name in classes
+
+
+def make_strainer(*selectors: tuple[str, str | None]):
+    """
+    Build a SoupStrainer that only keeps the given containers (and everything inside them).
+
+    Parameters
+    ----------
+    selectors : tuple[str, str | None]
+        (tag name, class name) of the containers, class name None match any tag with that name.
+
+    Returns
+    ----------
+    SoupStrainer
+    """
+
+    def match(name, attrs):
+        if not isinstance(name, str):
+            return False
+
+        for tag_name, class_name in selectors:
+            if name == tag_name and (class_name is None or has_class(attrs, class_name)):
+                return True
+        return False
+
+    return SoupStrainer(match)
+
+
+def parse_html(content: bytes, strainer: SoupStrainer = None, features: str = None):
+    """
+    Parse a page, only the parts matched by the strainer are built when it is given.
+
+    Returns
+    ----------
+    BeautifulSoup
+    """
+
+    start_time = perf_counter()
+    soup = BeautifulSoup(content, features or DEFAULT_FEATURES, parse_only=strainer)
+    parse_stats['pages'] += 1
+    parse_stats['seconds'] += perf_counter() - start_time
+    return soup
+
+
+def reset_parse_stats():
+    parse_stats['pages'] = 0
+    parse_stats['seconds'] = 0.0
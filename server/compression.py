@@ -0,0 +1,205 @@
+import gzip
+import anyio.to_thread
+from collections import OrderedDict
+from time import perf_counter
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/javascript')
+
+# number of responses, compressed responses, cache hits, bytes before/after compression and compression time
+compression_stats = {'responses': 0, 'compressed': 0, 'cache_hits': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+
+
+def parse_accept_encoding(value: str):
+    """
+    Returns
+    ----------
+    dict
+        {encoding: quality}
+    """
+
+    encodings = {}
+    for item in value.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            encodings[name.lower()] = quality
+
+    return encodings
+
+
+class CompressionMiddleware:
+    """
+    Compress the responses bigger than minimum_size with brotli (if installed) or gzip,
+    depending on the Accept-Encoding of the request.
+
+    The responses with an ETag always have the same body, their compressed body is kept in a LRU cache
+    (keyed by ETag and encoding) so the hot articles are only compressed once.
+    The ETag of a compressed response becomes weak (the body is a different representation).
+
+    The bodies bigger than thread_size are compressed in a worker thread so they don't block the event loop
+    (the cache is only read and written on the event loop).
+    """
+
+    def __init__(self, app, minimum_size=1024, encodings=('br', 'gzip'), gzip_level=6, brotli_quality=5,
+                 cache_size=1024, thread_size=64 * 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.thread_size = thread_size
+        self.encodings = [encoding for encoding in encodings if encoding != 'br' or brotli is not None]
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def select_encoding(self, accept_encoding: str):
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in self.encodings:
+            if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+                return encoding
+        return None
+
+    def compress(self, body: bytes, encoding: str):
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    def timed_compress(self, body: bytes, encoding: str):
+        """
+        Returns
+        ----------
+        tuple[bytes, float]
+            Compressed body and compression time in seconds.
+        """
+
+        start_time = perf_counter()
+        compressed_body = self.compress(body, encoding)
+        return compressed_body, perf_counter() - start_time
+
+    def get_cached_body(self, encoding: str, etag: str = None):
+        key = (etag, encoding)
+        if etag is not None and key in self.cache:
+            self.cache.move_to_end(key)
+            compression_stats['cache_hits'] += 1
+            return self.cache[key]
+        return None
+
+    def cache_body(self, compressed_body: bytes, seconds: float, encoding: str, etag: str = None):
+        compression_stats['seconds'] += seconds
+        if etag is not None:
+            self.cache[(etag, encoding)] = compressed_body
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return compressed_body
+
+    def get_compressed_body(self, body: bytes, encoding: str, etag: str = None):
+        compressed_body = self.get_cached_body(encoding, etag)
+        if compressed_body is None:
+            compressed_body = self.cache_body(*self.timed_compress(body, encoding), encoding, etag)
+        return compressed_body
+
+    async def get_compressed_body_async(self, body: bytes, encoding: str, etag: str = None):
+        if len(body) < self.thread_size:
+            return self.get_compressed_body(body, encoding, etag)
+
+        compressed_body = self.get_cached_body(encoding, etag)
+        if compressed_body is None:
+            compressed_body, seconds = await anyio.to_thread.run_sync(self.timed_compress, body, encoding)
+            compressed_body = self.cache_body(compressed_body, seconds, encoding, etag)
+        return compressed_body
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self.select_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        body_parts = []
+
+        async def send_compressed(message):
+            nonlocal start_message
+            if message['type'] == 'http.response.start':
+                start_message = message
+                return
+
+            if message['type'] != 'http.response.body':
+                await send(message)
+                return
+
+            body_parts.append(message.get('body', b''))
+            if message.get('more_body', False):
+                return
+
+            await self.send_response(send, start_message, b''.join(body_parts), encoding)
+
+        await self.app(scope, receive, send_compressed)
+
+    async def send_response(self, send, start_message: dict, body: bytes, encoding: str):
+        headers = MutableHeaders(raw=start_message['headers'])
+        headers.add_vary_header('Accept-Encoding')
+        etag = headers.get('etag')
+        compression_stats['responses'] += 1
+        compression_stats['bytes_in'] += len(body)
+
+        content_type = headers.get('content-type', '')
+        compressible = (
+            start_message['status'] == 200
+            and 'content-encoding' not in headers
+            and len(body) >= self.minimum_size
+            and content_type.startswith(COMPRESSIBLE_TYPES)
+        )
+        if compressible:
+            compressed_body = await self.get_compressed_body_async(body, encoding, etag)
+            compression_stats['compressed'] += 1
+            headers['Content-Encoding'] = encoding
+            headers['Content-Length'] = str(len(compressed_body))
+            body = compressed_body
+
+        # same ETag for the 304 of a client that got the compressed body
+        if etag is not None and not etag.startswith('W/') and (compressible or start_message['status'] == 304):
+            headers['ETag'] = 'W/' + etag
+
+        compression_stats['bytes_out'] += len(body)
+        await send(start_message)
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def reset_compression_stats():
+    for key in compression_stats:
+        compression_stats[key] = 0.0 if key == 'seconds' else 0
+
+
+def report_compression():
+    """
+    Print the bytes on wire and the compression time since the last reset.
+
+    Returns
+    ----------
+    dict
+    """
+
+    stats = dict(compression_stats)
+    compressed = max(stats['compressed'], 1)
+    ratio = stats['bytes_out'] / stats['bytes_in'] if stats['bytes_in'] > 0 else 1.0
+    print(f"Responses: {stats['responses']}, compressed: {stats['compressed']}, cache hits: {stats['cache_hits']}")
+    print(f"Bytes: {stats['bytes_in']} -> {stats['bytes_out']} ({ratio:.2%}), "
+          f"compression time: {stats['seconds'] / compressed * 1e6:.1f} us per compressed response")
+    return stats
@@ -0,0 +1,163 @@
+import numba
+import numpy as np
+
+
+FLOAT32_EPS = np.finfo(np.float32).eps
+FLOAT32_MAX = np.finfo(np.float32).max
+
+
+@numba.njit(fastmath=True, cache=True)
+def combined_distance(x, y):
+    # prepare
+    dim = x.shape[0]
+    norm_x = 0.0
+    norm_y = 0.0
+    l1_norm_x = 0.0
+    l1_norm_y = 0.0
+    
+    for i in range(dim):
+        l1_norm_x += x[i]
+        l1_norm_y += y[i]
+        norm_x += x[i] ** 2
+        norm_y += y[i] ** 2
+
+    # cosine
+    if norm_x == 0.0 and norm_y == 0.0:
+        result_cos = 0.0
+    elif norm_x == 0.0 or norm_y == 0.0:
+        result_cos = 1.0
+    else:
+        result_cos = 0.0
+        for i in range(dim):
+            result_cos += x[i] * y[i]
+        result_cos = 1.0 - (result_cos / np.sqrt(norm_x * norm_y))
+        
+    # jensen shannon
+    result_jen = 0.0
+    l1_norm_x_jen = l1_norm_x + FLOAT32_EPS * dim
+    l1_norm_y_jen = l1_norm_y + FLOAT32_EPS * dim
+
+    pdf_x = (x + FLOAT32_EPS) / l1_norm_x_jen
+    pdf_y = (y + FLOAT32_EPS) / l1_norm_y_jen
+    m = 0.5 * (pdf_x + pdf_y)
+
+    for i in range(dim):
+        result_jen += 0.5 * (
+            pdf_x[i] * np.log(pdf_x[i] / m[i]) + pdf_y[i] * np.log(pdf_y[i] / m[i])
+        )
+        
+    # hellinger
+    if l1_norm_x == 0 and l1_norm_y == 0:
+        result_hel = 0.0
+    elif l1_norm_x == 0 or l1_norm_y == 0:
+        result_hel = 1.0
+    else:
+        result_hel = 0.0
+        for i in range(dim):
+            result_hel += np.sqrt(x[i] * y[i])
+        result_hel = np.sqrt(1 - result_hel / np.sqrt(l1_norm_x * l1_norm_y))
+        
+    # jaccard
+    if l1_norm_x == 0 and l1_norm_y == 0:
+        result_jac = 0.0
+    elif l1_norm_x == 0 or l1_norm_y == 0:
+        result_jac = 1.0
+    else:
+        intersection = 0.0
+        union = 0.0
+        for i in range(dim):
+            if x[i] <= y[i]:
+                intersection += x[i]
+                union += y[i]
+            else:
+                intersection += y[i]
+                union += x[i]
+        result_jac = 1 - intersection / union
+    
+    # combined
+    return (result_cos + result_jen + result_hel + result_jac) / 4
+
+
+@numba.njit(fastmath=True, cache=True)
+def sparse_combined_distance(ind1, data1, ind2, data2, dim):
+    """
+    combined_distance of two sparse rows (sorted topic indices and their values),
+    the topics missing from both rows only change the Jensen-Shannon term and are added at once.
+    """
+
+    l1_norm_x = 0.0
+    l1_norm_y = 0.0
+    norm_x = 0.0
+    norm_y = 0.0
+    for value in data1:
+        l1_norm_x += value
+        norm_x += value ** 2
+    for value in data2:
+        l1_norm_y += value
+        norm_y += value ** 2
+
+    l1_norm_x_jen = l1_norm_x + FLOAT32_EPS * dim
+    l1_norm_y_jen = l1_norm_y + FLOAT32_EPS * dim
+
+    # walk the union of the topics of both rows
+    dot = 0.0
+    hellinger = 0.0
+    intersection = 0.0
+    result_jen = 0.0
+    union_size = 0
+    i = 0
+    j = 0
+    while i < ind1.shape[0] or j < ind2.shape[0]:
+        if j >= ind2.shape[0] or (i < ind1.shape[0] and ind1[i] < ind2[j]):
+            x = data1[i]
+            y = 0.0
+            i += 1
+        elif i >= ind1.shape[0] or ind2[j] < ind1[i]:
+            x = 0.0
+            y = data2[j]
+            j += 1
+        else:
+            x = data1[i]
+            y = data2[j]
+            i += 1
+            j += 1
+
+        union_size += 1
+        dot += x * y
+        hellinger += np.sqrt(x * y)
+        intersection += min(x, y)
+        pdf_x = (x + FLOAT32_EPS) / l1_norm_x_jen
+        pdf_y = (y + FLOAT32_EPS) / l1_norm_y_jen
+        m = 0.5 * (pdf_x + pdf_y)
+        result_jen += 0.5 * (pdf_x * np.log(pdf_x / m) + pdf_y * np.log(pdf_y / m))
+
+    pdf_x = FLOAT32_EPS / l1_norm_x_jen
+    pdf_y = FLOAT32_EPS / l1_norm_y_jen
+    m = 0.5 * (pdf_x + pdf_y)
+    result_jen += (dim - union_size) * 0.5 * (pdf_x * np.log(pdf_x / m) + pdf_y * np.log(pdf_y / m))
+
+    # cosine
+    if norm_x == 0.0 and norm_y == 0.0:
+        result_cos = 0.0
+    elif norm_x == 0.0 or norm_y == 0.0:
+        result_cos = 1.0
+    else:
+        result_cos = 1.0 - (dot / np.sqrt(norm_x * norm_y))
+
+    # hellinger
+    if l1_norm_x == 0 and l1_norm_y == 0:
+        result_hel = 0.0
+    elif l1_norm_x == 0 or l1_norm_y == 0:
+        result_hel = 1.0
+    else:
+        result_hel = np.sqrt(1 - hellinger / np.sqrt(l1_norm_x * l1_norm_y))
+
+    # jaccard
+    if l1_norm_x == 0 and l1_norm_y == 0:
+        result_jac = 0.0
+    elif l1_norm_x == 0 or l1_norm_y == 0:
+        result_jac = 1.0
+    else:
+        result_jac = 1 - intersection / (l1_norm_x + l1_norm_y - intersection)
+
+    return (result_cos + result_jen + result_hel + result_jac) / 4
@@ -0,0 +1,248 @@
+import numba
+import numpy as np
+from time import perf_counter
+from server import data
+from server.shards import merge_neighbor_graph
+
+
+def load_category_array(generation: int = None, refresh=False):
+    """
+    Category code of every row of a generation, saved next to its graph (data.save_article_columns)
+    so the categories are only downloaded once.
+
+    Returns
+    ----------
+    tuple[np.ndarray, np.ndarray]
+        int32 category code of every row (-1 if the article is missing) and the category names.
+    """
+
+    columns = data.load_article_columns(generation, refresh=refresh)
+    return columns['categories'], columns['category_names']
+
+
+@numba.njit(parallel=True)
+def exact_neighbors(matrix, queries, k, distance):
+    """
+    Brute force k nearest rows of matrix for every query with the distance function (numba function).
+    """
+
+    neighbors = np.empty((queries.shape[0], k), dtype=np.int64)
+    for i in numba.prange(queries.shape[0]):
+        distances = np.empty(matrix.shape[0], dtype=np.float32)
+        for j in range(matrix.shape[0]):
+            distances[j] = distance(queries[i], matrix[j])
+        neighbors[i] = np.argsort(distances, kind='mergesort')[:k]
+    return neighbors
+
+
+def compute_recall(approximate: np.ndarray, exact: np.ndarray):
+    k = exact.shape[1]
+    hits = sum(len(set(row[:k]) & set(exact_row)) for row, exact_row in zip(approximate, exact))
+    return hits / exact.size
+
+
+def compute_sampled_recall(neighbor_graph: np.ndarray, matrix: np.ndarray, distance, k=10, sample_size=200, seed=0):
+    """
+    Recall@k of the graph against the exact neighbors of sampled rows (brute force on the whole matrix).
+    """
+
+    sample = np.random.default_rng(seed).choice(matrix.shape[0], min(sample_size, matrix.shape[0]), replace=False)
+    exact = exact_neighbors(matrix, matrix[sample], min(k, matrix.shape[0]), distance)
+    return compute_recall(neighbor_graph[sample], exact)
+
+
+def get_recommendations(neighbor_graph: np.ndarray, k: int):
+    """
+    First k neighbors of every row without the row itself and the missing neighbors (-1).
+
+    Returns
+    ----------
+    tuple[np.ndarray, np.ndarray]
+        (n, k) recommended rows (0 where missing) and the (n, k) mask of the valid ones.
+    """
+
+    rows = np.arange(neighbor_graph.shape[0])[:, None]
+    valid = (neighbor_graph >= 0) & (neighbor_graph != rows)
+    # stable sort on the invalid flag keeps the order of the neighbors
+    order = np.argsort(~valid, axis=1, kind='stable')[:, :k]
+    recommendations = np.take_along_axis(neighbor_graph, order, axis=1)
+    valid = np.take_along_axis(valid, order, axis=1)
+    return np.where(valid, recommendations, 0), valid
+
+
+def compute_topic_diversity(recommendations: np.ndarray, valid: np.ndarray, topic_distributions: np.ndarray,
+                            batch_size=100_000):
+    """
+    Mean cosine distance between the recommendations of a list, averaged over the lists.
+    """
+
+    norms = np.linalg.norm(topic_distributions, axis=1, keepdims=True)
+    vectors = (topic_distributions / np.maximum(norms, np.finfo(np.float32).tiny)).astype(np.float32)
+
+    total = 0.0
+    lists = 0
+    for start in range(0, recommendations.shape[0], batch_size):
+        batch = vectors[recommendations[start:start + batch_size]] * valid[start:start + batch_size, :, None]
+        similarities = np.einsum('nkd,njd->nkj', batch, batch)
+        counts = valid[start:start + batch_size].sum(axis=1)
+        pairs = counts * (counts - 1)
+        # the diagonal is 1 for every valid recommendation
+        distances = pairs - (similarities.sum(axis=(1, 2)) - counts)
+        total += (distances[pairs > 0] / pairs[pairs > 0]).sum()
+        lists += (pairs > 0).sum()
+
+    return total / max(lists, 1)
+
+
+def evaluate_graph(neighbor_graph: np.ndarray, categories: np.ndarray, k=10, topic_distributions: np.ndarray = None):
+    """
+    Quality of the top k recommendations of a neighbor graph, categories is aligned with its rows
+    (-1 for an unknown category, those rows are not evaluated).
+
+    Returns
+    ----------
+    dict
+        - precision@k: share of the recommendations in the category of the article.
+        - category_agreement: share of the articles whose most recommended category is their own.
+        - coverage: share of the articles recommended at least once.
+        - popularity_gini: gini coefficient of the number of times every article is recommended.
+        - top_1%_share: share of the recommendations going to the 1% most recommended articles.
+        - category_diversity: share of the pairs of a list in different categories.
+        - topic_diversity: mean cosine distance inside a list (with topic_distributions only).
+    """
+
+    n = neighbor_graph.shape[0]
+    recommendations, valid = get_recommendations(neighbor_graph, k)
+    known = categories >= 0
+    recommended_categories = categories[recommendations]
+    valid &= recommended_categories >= 0
+    evaluated = known & (valid.sum(axis=1) > 0)
+
+    same_category = (recommended_categories == categories[:, None]) & valid
+    precision = same_category[evaluated].sum() / max(valid[evaluated].sum(), 1)
+
+    # per row category counts of the recommendations
+    num_categories = int(categories.max()) + 1 if n > 0 else 0
+    flat = (np.arange(n)[:, None] * num_categories + recommended_categories)[valid]
+    category_counts = np.bincount(flat, minlength=n * num_categories).reshape(n, num_categories)
+    # no known category (every category is -1): there is nothing to agree on
+    agreement = 0.0
+    if num_categories > 0 and evaluated.any():
+        agreement = (category_counts.argmax(axis=1) == categories)[evaluated].mean()
+
+    counts = valid.sum(axis=1)
+    pairs = counts * (counts - 1)
+    same_pairs = (category_counts * (category_counts - 1)).sum(axis=1)
+    category_diversity = ((pairs - same_pairs)[pairs > 0] / pairs[pairs > 0]).mean() if (pairs > 0).any() else 0.0
+
+    in_degree = np.bincount(recommendations[valid], minlength=n)
+    sorted_degree = np.sort(in_degree)
+    total = max(sorted_degree.sum(), 1)
+    gini = 1 - 2 * (np.cumsum(sorted_degree) / total).sum() / n + 1 / n
+    top_share = sorted_degree[-max(n // 100, 1):].sum() / total
+
+    result = {
+        'rows': n,
+        f'precision@{k}': precision,
+        'category_agreement': agreement,
+        'coverage': (in_degree > 0).mean(),
+        'popularity_gini': gini,
+        'top_1%_share': top_share,
+        'category_diversity': category_diversity,
+    }
+    if topic_distributions is not None:
+        result['topic_diversity'] = compute_topic_diversity(recommendations, valid, topic_distributions)
+
+    return result
+
+
+def compute_overlap(graph_a: np.ndarray, graph_b: np.ndarray, k=10, batch_size=100_000):
+    """
+    Mean share of the top k recommendations of graph_a also in the top k of graph_b (same rows).
+    """
+
+    recommendations_a, valid_a = get_recommendations(graph_a, k)
+    recommendations_b, valid_b = get_recommendations(graph_b, k)
+
+    common = 0
+    for start in range(0, recommendations_a.shape[0], batch_size):
+        batch = slice(start, start + batch_size)
+        matches = recommendations_a[batch, :, None] == recommendations_b[batch, None, :]
+        matches &= valid_a[batch, :, None] & valid_b[batch, None, :]
+        common += matches.any(axis=2).sum()
+
+    return common / max(valid_a.sum(), 1)
+
+
+def evaluate_generation(generation: int = None, k=10, graph_path: str = None):
+    """
+    Evaluate the graph of a generation (default the published one) or the graph file graph_path
+    with the rows of the generation.
+
+    Returns
+    ----------
+    dict
+    """
+
+    if generation is None:
+        generation = data.get_published_generation()
+
+    start_time = perf_counter()
+    categories, _ = load_category_array(generation)
+    if graph_path is not None:
+        neighbor_graph = np.load(graph_path)
+    else:
+        # neighbors merged across the recent shards, as served by the API
+        neighbor_graph = merge_neighbor_graph(data.load_generation(generation), k + 1)
+    topic_distributions = data.load_topic_distributions(generation=generation)
+    if topic_distributions.shape[0] != neighbor_graph.shape[0]:
+        topic_distributions = None
+
+    result = evaluate_graph(neighbor_graph, categories, k, topic_distributions)
+    print_evaluation({graph_path or f'generation {generation}': result})
+    print(f'Evaluated in {perf_counter() - start_time:.2f}s')
+    return result
+
+
+def compare_graphs(graph_path_a: str, graph_path_b: str, generation: int = None, k=10):
+    """
+    Evaluate two graph files with the rows of the same generation side by side, with their overlap.
+
+    Returns
+    ----------
+    dict
+        {graph path: evaluation, 'overlap@k': float}
+    """
+
+    if generation is None:
+        generation = data.get_published_generation()
+
+    categories, _ = load_category_array(generation)
+    topic_distributions = data.load_topic_distributions(generation=generation)
+    results = {}
+    graphs = {}
+    for path in [graph_path_a, graph_path_b]:
+        graphs[path] = np.load(path)
+        topics = topic_distributions if topic_distributions.shape[0] == graphs[path].shape[0] else None
+        results[path] = evaluate_graph(graphs[path], categories, k, topics)
+
+    print_evaluation(results)
+    overlap = compute_overlap(graphs[graph_path_a], graphs[graph_path_b], k)
+    print(f'Overlap@{k}: {overlap:.2%}')
+    return {**results, f'overlap@{k}': overlap}
+
+
+def print_evaluation(results: dict):
+    names = list(results)
+    metrics = list(results[names[0]])
+    print(f"{'':<20}" + ''.join(f'{name[-30:]:>32}' for name in names))
+    for metric in metrics:
+        values = [results[name].get(metric) for name in names]
+        print(f'{metric:<20}' + ''.join(
+            f'{value:>32}' if isinstance(value, (int, np.integer)) else f'{value:>32.4f}' if value is not None else ' ' * 32
+            for value in values
+        ))
+
+
+if __name__ == '__main__':
+    evaluate_generation()
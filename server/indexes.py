@@ -0,0 +1,48 @@
+from pymongo import ASCENDING, DESCENDING
+from server.data import connect_to_mongo
+
+
+# {collection name: [(keys, options)]}
+INDEXES = {
+    'newspaper': [
+        # listing of a category / of the latest articles
+        ([("category", ASCENDING), ("published_date", DESCENDING)], {}),
+        ([("published_date", DESCENDING)], {}),
+        # duplicated links check of the crawlers
+        ([("web", ASCENDING), ("link_id", ASCENDING)], {}),
+    ],
+    'temporary_newspaper': [
+        # an interrupted crawl is resumed into the same collection -> reject re-crawled articles
+        ([("web", ASCENDING), ("link_id", ASCENDING)], {"unique": True}),
+    ],
+    'black_list': [
+        ([("web", ASCENDING), ("link_id", ASCENDING)], {}),
+    ],
+    'crawl_frontier': [
+        ([("web", ASCENDING), ("link_id", ASCENDING)], {"unique": True}),
+        ([("web", ASCENDING), ("category", ASCENDING), ("status", ASCENDING)], {}),
+    ],
+    'recommendations': [
+        ([("article_id", ASCENDING), ("generation", DESCENDING)], {}),
+    ],
+    'update_jobs': [
+        ([("status", ASCENDING), ("created_at", ASCENDING)], {}),
+    ],
+    'update_runs': [
+        ([("started_at", DESCENDING)], {}),
+    ],
+}
+
+
+def ensure_indexes(db=None):
+    """
+    Create the declared indexes (existing ones are left as they are).
+    """
+
+    if db is None:
+        with connect_to_mongo() as client:
+            return ensure_indexes(client['Ganesha_News'])
+
+    for collection_name, indexes in INDEXES.items():
+        for keys, options in indexes:
+            db[collection_name].create_index(keys, **options)
@@ -0,0 +1,224 @@
+import json
+import os
+import resource
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import perf_counter
+from numba.core import event
+from pymongo import DESCENDING
+from server import data
+
+
+UPDATE_LOG_PATH = 'update_log/update_runs.jsonl'
+
+
+def read_proc_status():
+    """
+    Returns
+    ----------
+    dict
+        {'rss': current resident memory, 'peak_rss': peak resident memory since the last reset} in bytes,
+        empty if /proc is not available.
+    """
+
+    memory = {}
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    memory['rss'] = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    memory['peak_rss'] = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return memory
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory of the process (Linux), so the peak of every stage can be measured.
+
+    Returns
+    ----------
+    bool
+        False if the peak can't be reset, the peak is then the one of the whole process.
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_memory_usage():
+    """
+    Returns
+    ----------
+    dict
+        {'rss_mb', 'peak_rss_mb'} of the process.
+    """
+
+    memory = read_proc_status()
+    # ru_maxrss is in KB on Linux, it can't be reset
+    peak_rss = memory.get('peak_rss', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    return {
+        'rss_mb': round(memory.get('rss', peak_rss) / 2 ** 20, 1),
+        'peak_rss_mb': round(peak_rss / 2 ** 20, 1),
+    }
+
+
+class UpdateRun:
+    """
+    Structured instrumentation of one update: every stage records its time, the peak resident memory
+    and the numba compilation time spent in it, the counters are added by the stages (crawled pages, bytes,
+    failures per site/category).
+
+    The events are appended as JSON lines to log_path and the summary of the run is also stored
+    in the update_runs collection, to follow the trends across the daily runs (see report_update_runs).
+    """
+
+    def __init__(self, generation: int = None, log_path=UPDATE_LOG_PATH):
+        self.run_id = uuid.uuid4().hex
+        self.generation = generation
+        self.log_path = log_path
+        self.started_at = datetime.now(timezone.utc)
+        self.start_time = perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        self.emit('start')
+
+    def emit(self, event_name: str, **fields):
+        line = {
+            'run_id': self.run_id,
+            'generation': self.generation,
+            'time': datetime.now(timezone.utc).isoformat(),
+            'event': event_name,
+            **fields,
+        }
+        with open(self.log_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(line, ensure_ascii=False) + '\n')
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measure the block as the stage name, the stage is recorded even if the block raises.
+        """
+
+        peak_reset = reset_peak_rss()
+        compile_times = []
+        start_time = perf_counter()
+        status = 'failed'
+        try:
+            with event.install_timer('numba:compile', compile_times.append):
+                yield self
+            status = 'done'
+        finally:
+            stage = {
+                'seconds': round(perf_counter() - start_time, 3),
+                'numba_compile_seconds': round(sum(compile_times), 3),
+                **get_memory_usage(),
+                'peak_rss_is_stage': peak_reset,
+                'status': status,
+            }
+            self.stages[name] = stage
+            self.emit('stage', stage=name, **stage)
+            print(f"Executed time: {stage['seconds']:.3f}s, peak RSS: {stage['peak_rss_mb']} MB, "
+                  f"numba compile: {stage['numba_compile_seconds']:.3f}s")
+
+    def add_counters(self, name: str, counters: dict):
+        """
+        Record the counters of a stage (nested dicts of numbers are allowed).
+        """
+
+        self.counters[name] = counters
+        self.emit('counters', name=name, counters=counters)
+
+    def finish(self, status: str, save=True):
+        """
+        Emit the summary of the run, print it and store it in the update_runs collection.
+
+        Returns
+        ----------
+        dict
+        """
+
+        children_peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        summary = {
+            'run_id': self.run_id,
+            'generation': self.generation,
+            'status': status,
+            'started_at': self.started_at,
+            'finished_at': datetime.now(timezone.utc),
+            'seconds': round(perf_counter() - self.start_time, 3),
+            'stages': self.stages,
+            'counters': self.counters,
+            'peak_rss_mb': max(
+                [round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)]
+                + [stage['peak_rss_mb'] for stage in self.stages.values()]
+            ),
+            'children_peak_rss_mb': round(children_peak_rss / 2 ** 20, 1),
+        }
+        self.emit('summary', **{
+            **summary,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': summary['finished_at'].isoformat(),
+        })
+
+        print(f"\nUpdate run {self.run_id} ({status}) in {summary['seconds']:.2f}s, "
+              f"peak RSS: {summary['peak_rss_mb']} MB (workers: {summary['children_peak_rss_mb']} MB)")
+        for name, stage in self.stages.items():
+            print(f"{name}: {stage['seconds']:.2f}s, peak RSS {stage['peak_rss_mb']} MB, "
+                  f"numba compile {stage['numba_compile_seconds']:.2f}s")
+
+        if save:
+            with data.connect_to_mongo() as client:
+                client['Ganesha_News']['update_runs'].insert_one(dict(summary))
+
+        return summary
+
+
+def load_update_runs(limit=30, status: str = None):
+    """
+    Returns
+    ----------
+    list[dict]
+        Summaries of the latest runs, the oldest first.
+    """
+
+    query = {} if status is None else {"status": status}
+    with data.connect_to_mongo() as client:
+        runs = list(client['Ganesha_News']['update_runs'].find(query, {"_id": 0}).sort("started_at", DESCENDING).limit(limit))
+
+    return runs[::-1]
+
+
+def report_update_runs(limit=30, status: str = None):
+    """
+    Print the time and the peak memory of every stage for the latest runs.
+
+    Returns
+    ----------
+    list[dict]
+    """
+
+    runs = load_update_runs(limit, status)
+    stage_names = []
+    for run in runs:
+        stage_names += [name for name in run['stages'] if name not in stage_names]
+
+    print(f"{'started at':<17} {'status':<11} {'total':>8} " + ' '.join(f'{name:>18}' for name in stage_names))
+    for run in runs:
+        stages = [
+            f"{run['stages'][name]['seconds']:>8.1f}s {run['stages'][name]['peak_rss_mb']:>6.0f}MB"
+            if name in run['stages'] else ' ' * 18
+            for name in stage_names
+        ]
+        print(f"{run['started_at']:%Y-%m-%d %H:%M}  {run['status']:<11} {run['seconds']:>7.1f}s " + ' '.join(stages))
+
+    return runs
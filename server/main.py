@@ -1,35 +1,66 @@
 import asyncio
 from typing import Annotated
-from fastapi import FastAPI, Query, HTTPException
-from server.model import Article, Category, ArticleRecommendation, ShortArticle, PyObjectId, SearchResponse
-from server.data import load_neighbor_graph, connect_to_mongo
-from server.updater import update_new_articles
+from fastapi import FastAPI, Query, HTTPException, Request
+from server.model import (
+    Category, ArticleRecommendation, ShortArticle, PyObjectId, SearchResponse, ArticleBatchRequest, ArticleBatchResponse
+)
+from server.response import MongoJSONResponse, cached_response, make_etag
+from server.data import load_generation, connect_to_mongo, get_publish_info
+from server.queries import (
+    find, find_one, get_article_query, get_articles_query, get_batch_recommendation_query, get_listing_query,
+    get_recommendation_query, get_search_query
+)
+from server.indexes import ensure_indexes
+from server.compression import CompressionMiddleware
+from server.metrics import MetricsMiddleware, MongoCommandListener, metrics_response, record_recommendation_lookup
+from server.ranking import RERANK_OVERFETCH, RERANK_WEIGHTS, rerank_rows
+from server.shards import get_candidate_rows
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import re
 
 
-async def periodic_task():
-    global neighbor_graph
-    await asyncio.sleep(5)
+RELOAD_INTERVAL = 60
+
+# articles never change and their recommendations change at most once per update
+ARTICLE_CACHE_CONTROL = 'public, max-age=3600, stale-while-revalidate=86400'
+# listings change when a generation is published, revalidated with the ETag after that
+LISTING_CACHE_CONTROL = 'public, max-age=300, stale-while-revalidate=3600'
+
+
+async def reload_published_update():
+    """
+    The update runs in the updater worker (server/worker.py),
+    the new generation is loaded when the worker publishes it then swapped at once,
+    a request always uses the graph and the articles of a single generation.
+    """
+
+    global published
     while True:
-        neighbor_graph = await asyncio.to_thread(update_new_articles, limit=5)
-        await asyncio.sleep(60 * 60 * 24)
+        await asyncio.sleep(RELOAD_INTERVAL)
+        try:
+            generation, published_at = await asyncio.to_thread(get_publish_info, database)
+            if generation != published['generation']:
+                published = await asyncio.to_thread(load_generation, generation, published_at)
+        except Exception as e:
+            print(f'Reload published update failed: {e}')
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global database, neighbor_graph
-    client = connect_to_mongo()
+    global database, published
+    client = connect_to_mongo(event_listeners=[MongoCommandListener()])
     database = client["Ganesha_News"]
-    neighbor_graph = load_neighbor_graph()
-    # asyncio.create_task(periodic_task())
+    ensure_indexes(database)
+    published = load_generation(*get_publish_info(database))
+    reload_task = asyncio.create_task(reload_published_update())
 
     yield
+    reload_task.cancel()
     client.close()
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=MongoJSONResponse)
 
 origins = [
     "http://localhost:3000",
@@ -45,65 +76,172 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(CompressionMiddleware, minimum_size=1024, gzip_level=6, brotli_quality=5, cache_size=1024,
+                   thread_size=64 * 1024)
+app.add_middleware(MetricsMiddleware)
+
+
+def get_recommended_ids(current: dict, row: int, candidate_rows, limit: int, rerank: bool):
+    """
+    Recommended article ids of a row from its candidate rows ordered by similarity,
+    re-ranked by freshness and category with the in-memory columns of the generation.
+    """
+
+    if rerank:
+        rows = rerank_rows(
+            row, candidate_rows, current['published_dates'], current['categories'], limit,
+            current['newest_published_date']
+        )
+    else:
+        rows = [index for index in candidate_rows if index >= 0 and index != row][:limit]
+
+    return [current['article_ids'][int(index)] for index in rows]
+
+
+def get_candidate_count(limit: int, rerank: bool):
+    return limit * RERANK_OVERFETCH if rerank else limit
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return metrics_response()
+
+
 @app.get("/articles", response_model=list[ShortArticle])
 def get_articles_by_category(
+    request: Request,
     page: Annotated[int, Query(ge=1, le=20)] = 1,
     limit: Annotated[int, Query(ge=10, le=40)] = 20,
     category: Category = Category.latest
 ):
-    query = {}
-    fields = {"title": 1, "description": 1, "thumbnail": 1}
-    sort_criteria = {"published_date": -1}
-    if category != Category.latest:
-        query = {"category": category}
-    
-    articles = database['newspaper'].find(query, fields).sort(sort_criteria).skip((page - 1) * limit).limit(limit)
-    return [ShortArticle(**article) for article in articles]
+    current = published
+    etag = make_etag('articles', category.value, page, limit, current['generation'])
+
+    def get_articles():
+        query = get_listing_query(current['generation'], None if category == Category.latest else category, page, limit)
+        return list(find(database, query))
+
+    return cached_response(request, get_articles, etag, LISTING_CACHE_CONTROL, current['published_at'])
 
 
 @app.get("/article/{article_id}", response_model=ArticleRecommendation)
 def get_article_and_recommendations_by_id(
+    request: Request,
     article_id: PyObjectId, 
     limit: Annotated[int, Query(ge=5, le=20)] = 10,
+    rerank: bool = True,
 ):    
-    article = database['newspaper'].find_one({"_id": article_id})
-    if article is None:
+    current = published
+    row = current['rows'].get(article_id)
+    if row is None:
         raise HTTPException(404, "Article not found")
-    
-    res_index = neighbor_graph[article['index']]
-    filter_index = res_index.astype(int).tolist()[1 : limit + 1]
-    query = {"index": {"$in": filter_index}}
-    fields = {"title": 1, "description": 1, "thumbnail": 1}
 
-    recommendation_list = database['newspaper'].find(query, fields)
-    article = Article(**article)
-    recommendations = [ShortArticle(**item) for item in recommendation_list]
-    return ArticleRecommendation(article=article, recommendations=recommendations)
+    # the article never changes, its recommendations only change with the generation
+    etag = make_etag(article_id, current['generation'], limit, rerank and sorted(RERANK_WEIGHTS.items()))
+    candidate_count = get_candidate_count(limit, rerank)
+
+    def get_article_and_recommendations():
+        article = find_one(database, get_article_query(article_id))
+        if article is None:
+            raise HTTPException(404, "Article not found")
+        
+        # recommendations materialized by the updater, computed from the graph if they don't exist yet
+        recommendation = find_one(database, get_recommendation_query(article_id, current['generation'], candidate_count))
+        record_recommendation_lookup('graph' if recommendation is None else 'materialized')
+        if recommendation is not None:
+            short_articles = {doc['_id']: doc for doc in recommendation['articles']}
+            candidate_rows = [current['rows'].get(id, -1) for id in recommendation.get('neighbors', short_articles)]
+        else:
+            candidate_rows = get_candidate_rows(current, row, candidate_count)
+            short_articles = None
+
+        recommended_ids = get_recommended_ids(current, row, candidate_rows, limit, rerank)
+        if short_articles is None:
+            short_articles = {doc['_id']: doc for doc in find(database, get_articles_query(recommended_ids))}
+        recommendation_list = [short_articles[id] for id in recommended_ids if id in short_articles]
+
+        return {"article": article, "recommendations": recommendation_list}
+
+    return cached_response(request, get_article_and_recommendations, etag, ARTICLE_CACHE_CONTROL, current['published_at'])
+
+
+@app.post("/articles/batch", response_model=ArticleBatchResponse)
+def get_articles_by_ids(batch: ArticleBatchRequest):
+    """
+    Articles (short or with their content) and optionally their recommendations in one request.
+    Unknown ids are left out, the recommended articles are returned once even if they are shared.
+    """
+
+    current = published
+    article_ids = [article_id for article_id in dict.fromkeys(batch.ids) if article_id in current['rows']]
+    articles = {doc['_id']: doc for doc in find(database, get_articles_query(article_ids, batch.detail))}
+    article_ids = [article_id for article_id in article_ids if article_id in articles]
+
+    recommendations = {}
+    recommended_articles = {}
+    if batch.recommendations and len(article_ids) > 0:
+        candidate_count = get_candidate_count(batch.limit, batch.rerank)
+        query = get_batch_recommendation_query(article_ids, current['generation'], candidate_count)
+        materialized = {}
+        for doc in find(database, query):
+            # latest generation of every article
+            if doc['generation'] > materialized.get(doc['article_id'], {'generation': -1})['generation']:
+                materialized[doc['article_id']] = doc
+
+        # articles without materialized recommendations -> from the graph
+        missing_ids = []
+        for article_id in article_ids:
+            row = current['rows'][article_id]
+            doc = materialized.get(article_id)
+            if doc is not None:
+                short_articles = {item['_id']: item for item in doc['articles']}
+                candidate_rows = [current['rows'].get(id, -1) for id in doc.get('neighbors', short_articles)]
+                recommended_ids = get_recommended_ids(current, row, candidate_rows, batch.limit, batch.rerank)
+                recommendations[str(article_id)] = [id for id in recommended_ids if id in short_articles]
+                recommended_articles.update((id, short_articles[id]) for id in recommendations[str(article_id)])
+            else:
+                candidate_rows = get_candidate_rows(current, row, candidate_count)
+                recommendations[str(article_id)] = get_recommended_ids(
+                    current, row, candidate_rows, batch.limit, batch.rerank
+                )
+                missing_ids.extend(recommendations[str(article_id)])
+
+        missing_ids = list(set(missing_ids) - recommended_articles.keys())
+        if len(missing_ids) > 0:
+            recommended_articles.update((doc['_id'], doc) for doc in find(database, get_articles_query(missing_ids)))
+
+        recommendations = {
+            article_id: [item for item in items if item in recommended_articles]
+            for article_id, items in recommendations.items()
+        }
+
+    return MongoJSONResponse({
+        "articles": [articles[article_id] for article_id in article_ids],
+        "recommendations": recommendations,
+        "recommended_articles": list(recommended_articles.values()),
+    })
 
 
 @app.get("/search", response_model=SearchResponse)
 def get_articles_by_keyword(
+    request: Request,
     keyword: str,
     limit: Annotated[int, Query(ge=1, le=50)] = 30,
     page: Annotated[int, Query(ge=1, le=50)] = 1,
 ):
-    regex_pattern = re.compile(
-        fr"(?:\s+[“'\"]?{keyword}[”'\"]?$|^[“'\"]?{keyword}[”'\"]?\s+|\s+[“'\"]?{keyword}[”'\"]?\s+)", re.IGNORECASE
-    )
-
-    query = {
-        "$or": [
-            {"title": {"$regex": regex_pattern}},
-            {"description": {"$regex": regex_pattern}}
-        ]
-    }
-    fields = {"title": 1, "description": 1, "thumbnail": 1}
-    sort_criteria = {"published_date": -1}
-
-    combined_articles = list(database['newspaper'].find(query, fields).sort(sort_criteria))
-    start_index = min(len(combined_articles) - 1, (page - 1) * limit)
-    end_index = min(len(combined_articles), page * limit)
-
-    articles = [ShortArticle(**article) for article in combined_articles[start_index : end_index]]
-    return SearchResponse(articles=articles, total=min(len(combined_articles), limit * 50))
+    current = published
+    etag = make_etag('search', keyword, limit, page, current['generation'])
+
+    def get_articles():
+        regex_pattern = re.compile(
+            fr"(?:\s+[“'\"]?{keyword}[”'\"]?$|^[“'\"]?{keyword}[”'\"]?\s+|\s+[“'\"]?{keyword}[”'\"]?\s+)", re.IGNORECASE
+        )
+
+        combined_articles = list(find(database, get_search_query(current['generation'], regex_pattern)))
+        start_index = min(len(combined_articles) - 1, (page - 1) * limit)
+        end_index = min(len(combined_articles), page * limit)
+
+        articles = combined_articles[start_index : end_index]
+        return {"articles": articles, "total": min(len(combined_articles), limit * 50)}
 
+    return cached_response(request, get_articles, etag, LISTING_CACHE_CONTROL, current['published_at'])
@@ -0,0 +1,162 @@
+import json
+import os
+import random
+from contextvars import ContextVar
+from time import perf_counter
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily
+from pymongo import monitoring
+from server.compression import compression_stats
+
+
+# fraction of the requests printed as a JSON line with their spans (mongo commands, serialization)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SERIALIZATION_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Latency of the requests', ['method', 'route', 'status'], buckets=LATENCY_BUCKETS
+)
+REQUEST_MONGO_COMMANDS = Histogram(
+    'http_request_mongo_commands', 'Mongo commands sent per request', ['route'], buckets=(0, 1, 2, 3, 5, 10, 20, 50)
+)
+REQUEST_MONGO_TIME = Histogram(
+    'http_request_mongo_seconds', 'Mongo round trip time per request', ['route'], buckets=LATENCY_BUCKETS
+)
+SERIALIZATION_TIME = Histogram(
+    'http_response_serialization_seconds', 'JSON encoding time per request', ['route'], buckets=SERIALIZATION_BUCKETS
+)
+MONGO_COMMAND_LATENCY = Histogram(
+    'mongo_command_duration_seconds', 'Round trip time of the Mongo commands', ['command'], buckets=LATENCY_BUCKETS
+)
+NOT_MODIFIED = Counter('http_not_modified_total', 'Conditional requests answered with 304', ['route'])
+RECOMMENDATION_LOOKUPS = Counter(
+    'recommendation_lookups_total', 'Recommendation lookups by source (materialized or graph)', ['source']
+)
+
+# counters of the request being handled, shared with the threads running the endpoints
+request_context = ContextVar('request_context', default=None)
+
+
+def record_serialization(seconds: float):
+    context = request_context.get()
+    if context is not None:
+        context['serialization_seconds'] += seconds
+        if context['spans'] is not None:
+            context['spans'].append({'name': 'serialization', 'ms': seconds * 1000})
+
+
+def record_recommendation_lookup(source: str):
+    RECOMMENDATION_LOOKUPS.labels(source).inc()
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Time every Mongo command, the events are published by the thread that sent the command
+    so they are added to the counters of its request.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.record(event)
+
+    def record(self, event):
+        seconds = event.duration_micros / 1e6
+        MONGO_COMMAND_LATENCY.labels(event.command_name).observe(seconds)
+
+        context = request_context.get()
+        if context is not None:
+            context['mongo_commands'] += 1
+            context['mongo_seconds'] += seconds
+            if context['spans'] is not None:
+                context['spans'].append({'name': f'mongo.{event.command_name}', 'ms': seconds * 1000})
+
+
+class CompressionCollector:
+    """
+    Expose the compression stats (bytes on wire, compressed body cache hits) as counters.
+    """
+
+    def collect(self):
+        for key, name, documentation in [
+            ('responses', 'http_compression_responses', 'Responses seen by the compression middleware'),
+            ('compressed', 'http_compression_compressed', 'Compressed responses'),
+            ('cache_hits', 'http_compression_cache_hits', 'Compressed responses served from the cache'),
+            ('bytes_in', 'http_compression_bytes_in', 'Response bytes before compression'),
+            ('bytes_out', 'http_compression_bytes_out', 'Response bytes sent'),
+            ('seconds', 'http_compression_seconds', 'Time spent compressing'),
+        ]:
+            yield CounterMetricFamily(name, documentation, value=compression_stats[key])
+
+
+REGISTRY.register(CompressionCollector())
+
+
+class MetricsMiddleware:
+    """
+    Record the latency of every request by route with its Mongo commands and serialization time.
+    """
+
+    def __init__(self, app, excluded_paths=('/metrics',)):
+        self.app = app
+        self.excluded_paths = excluded_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in self.excluded_paths:
+            await self.app(scope, receive, send)
+            return
+
+        context = {
+            'mongo_commands': 0,
+            'mongo_seconds': 0.0,
+            'serialization_seconds': 0.0,
+            'spans': [] if random.random() < TRACE_SAMPLE_RATE else None,
+        }
+        token = request_context.set(context)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start_time = perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            executed_time = perf_counter() - start_time
+            request_context.reset(token)
+            # FastAPI routes give their path template, plain routes (docs) have a fixed path
+            route = scope.get('route')
+            if route is not None:
+                route_path = route.path
+            else:
+                route_path = scope['path'] if 'endpoint' in scope else 'unmatched'
+
+            REQUEST_LATENCY.labels(scope['method'], route_path, status).observe(executed_time)
+            REQUEST_MONGO_COMMANDS.labels(route_path).observe(context['mongo_commands'])
+            REQUEST_MONGO_TIME.labels(route_path).observe(context['mongo_seconds'])
+            SERIALIZATION_TIME.labels(route_path).observe(context['serialization_seconds'])
+            if status == 304:
+                NOT_MODIFIED.labels(route_path).inc()
+
+            if context['spans'] is not None:
+                print(json.dumps({
+                    'route': route_path,
+                    'path': scope['path'],
+                    'status': status,
+                    'ms': executed_time * 1000,
+                    'spans': context['spans'],
+                }))
+
+
+def metrics_response():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
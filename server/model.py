@@ -1,5 +1,6 @@
 from enum import Enum
-from pydantic import BaseModel, Field
+from typing import Annotated
+from pydantic import BaseModel, ConfigDict, Field, PlainSerializer, PlainValidator, WithJsonSchema
 from bson import ObjectId
 from datetime import datetime
 
@@ -18,24 +19,21 @@ class Category(str, Enum):
     latest = "moi-nhat"
 
 
-class PyObjectId(ObjectId):
-    @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
+def validate_object_id(value):
+    if isinstance(value, ObjectId):
+        return value
+    if isinstance(value, str) and ObjectId.is_valid(value):
+        return ObjectId(value)
+    raise ValueError(f"Invalid ObjectId: {value}")
 
-    @classmethod
-    def validate(cls, v, field):
-        if not ObjectId.is_valid(v):
-            raise ValueError(f"Invalid ObjectId: {v}")
-        return ObjectId(v)
 
-    @classmethod
-    def __get_pydantic_json_schema__(cls, schema, model_field) -> dict:
-        """
-        Generates a custom json schema for ObjectId,
-        telling Pydantic that the type is string with UUID format.
-        """
-        return {"type": "string", "format": "uuid"}
+# ObjectId accepted as ObjectId or string, serialized as string
+PyObjectId = Annotated[
+    ObjectId,
+    PlainValidator(validate_object_id),
+    PlainSerializer(str, return_type=str),
+    WithJsonSchema({"type": "string", "format": "uuid"}),
+]
 
 
 class Article(BaseModel):
@@ -47,8 +45,7 @@ class Article(BaseModel):
     description: str
     content: list[str | list[str]]
 
-    class Config:
-        json_encoders = {ObjectId: str}
+    model_config = ConfigDict(populate_by_name=True)
 
 
 class ShortArticle(BaseModel):
@@ -57,8 +54,12 @@ class ShortArticle(BaseModel):
     title: str
     description: str
 
-    class Config:
-        json_encoders = {ObjectId: str}
+    model_config = ConfigDict(populate_by_name=True)
+
+
+# projections of the documents returned as the models
+ARTICLE_FIELDS = {field.alias or name: 1 for name, field in Article.model_fields.items()}
+SHORT_ARTICLE_FIELDS = {field.alias or name: 1 for name, field in ShortArticle.model_fields.items()}
 
 
 class ArticleRecommendation(BaseModel):
@@ -69,3 +70,20 @@ class ArticleRecommendation(BaseModel):
 class SearchResponse(BaseModel):
     articles: list[ShortArticle]
     total: int
+
+
+MAX_BATCH_SIZE = 50
+
+
+class ArticleBatchRequest(BaseModel):
+    ids: list[PyObjectId] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+    detail: bool = False
+    recommendations: bool = False
+    limit: int = Field(10, ge=5, le=20)
+    rerank: bool = True
+
+
+class ArticleBatchResponse(BaseModel):
+    articles: list[Article | ShortArticle]
+    recommendations: dict[str, list[PyObjectId]]
+    recommended_articles: list[ShortArticle]
@@ -0,0 +1,97 @@
+from pymongo import DESCENDING
+from server.data import get_published_query
+from server.model import ARTICLE_FIELDS, SHORT_ARTICLE_FIELDS
+
+
+# The queries of the API are built here as {'collection', 'filter', 'projection', 'sort', 'skip', 'limit'},
+# the endpoints and the query plan check (benchmark/query_plans.py) send the same ones
+
+
+def make_query(collection: str, filter: dict, projection: dict = None, sort: list = None, skip=0, limit=0):
+    return {
+        'collection': collection, 'filter': filter, 'projection': projection, 'sort': sort, 'skip': skip, 'limit': limit
+    }
+
+
+def get_listing_query(generation: int, category: str = None, page=1, limit=20):
+    """
+    Page of the published articles of a category (None: every category) from the newest.
+    """
+
+    filter = get_published_query(generation)
+    if category is not None:
+        filter["category"] = category
+    return make_query(
+        'newspaper', filter, SHORT_ARTICLE_FIELDS, [("published_date", DESCENDING)], (page - 1) * limit, limit
+    )
+
+
+def get_search_query(generation: int, regex_pattern):
+    """
+    Published articles whose title or description match the keyword pattern from the newest.
+    """
+
+    filter = {
+        "$or": [
+            {"title": {"$regex": regex_pattern}},
+            {"description": {"$regex": regex_pattern}}
+        ],
+        **get_published_query(generation)
+    }
+    return make_query('newspaper', filter, SHORT_ARTICLE_FIELDS, [("published_date", DESCENDING)])
+
+
+def get_article_query(article_id):
+    return make_query('newspaper', {"_id": article_id}, ARTICLE_FIELDS, limit=1)
+
+
+def get_articles_query(article_ids: list, detail=False):
+    return make_query('newspaper', {"_id": {"$in": article_ids}}, ARTICLE_FIELDS if detail else SHORT_ARTICLE_FIELDS)
+
+
+def get_recommendation_query(article_id, generation: int, candidate_count: int):
+    """
+    Latest materialized recommendations of an article up to the generation, candidate_count neighbors at most.
+    """
+
+    return make_query(
+        'recommendations',
+        {"article_id": article_id, "generation": {"$lte": generation}},
+        {"neighbors": {"$slice": candidate_count}, "articles": {"$slice": candidate_count}},
+        [("generation", DESCENDING)], limit=1
+    )
+
+
+def get_batch_recommendation_query(article_ids: list, generation: int, candidate_count: int):
+    """
+    Materialized recommendations of several articles up to the generation, every generation of an article
+    is returned (not sorted, the latest one is kept by the caller).
+    """
+
+    return make_query(
+        'recommendations',
+        {"article_id": {"$in": article_ids}, "generation": {"$lte": generation}},
+        {
+            "article_id": 1, "generation": 1,
+            "neighbors": {"$slice": candidate_count}, "articles": {"$slice": candidate_count}
+        }
+    )
+
+
+def find(db, query: dict):
+    """
+    Cursor of a query built by the functions above.
+    """
+
+    cursor = db[query['collection']].find(query['filter'], query['projection'])
+    if query['sort'] is not None:
+        cursor = cursor.sort(query['sort'])
+    if query['skip'] > 0:
+        cursor = cursor.skip(query['skip'])
+    if query['limit'] > 0:
+        cursor = cursor.limit(query['limit'])
+    return cursor
+
+
+def find_one(db, query: dict):
+    return next(find(db, {**query, 'limit': 1}), None)
@@ -0,0 +1,37 @@
+import numpy as np
+
+
+# score of a recommendation = weighted sum of its similarity (rank among the neighbors),
+# its freshness (halved every half life) and the category match with the article
+RERANK_WEIGHTS = {'similarity': 1.0, 'freshness': 0.5, 'category': 0.2}
+FRESHNESS_HALF_LIFE_DAYS = 30
+# neighbors re-ranked per returned recommendation
+RERANK_OVERFETCH = 3
+
+
+def rerank_rows(row: int, candidates, published_dates: np.ndarray, categories: np.ndarray, limit: int,
+                reference_time: int, weights: dict = None, half_life_days=FRESHNESS_HALF_LIFE_DAYS):
+    """
+    Re-rank the candidate rows of a row (ordered by similarity) with the columns of the generation.
+    The freshness is measured from reference_time (the newest article of the generation) instead of the current time,
+    the ranking only changes with the generation so the responses keep their ETag.
+
+    Returns
+    ----------
+    np.ndarray
+        The limit best candidate rows, without the row itself and the missing ones (-1).
+    """
+
+    weights = weights or RERANK_WEIGHTS
+    candidates = np.asarray(candidates, dtype=np.int64)
+    candidates = candidates[(candidates >= 0) & (candidates != row)]
+    if len(candidates) == 0:
+        return candidates
+
+    similarity = 1.0 - np.arange(len(candidates)) / len(candidates)
+    age_days = np.maximum(reference_time - published_dates[candidates], 0) / 86400
+    freshness = np.exp2(-age_days / half_life_days)
+    same_category = (categories[candidates] == categories[row]) & (categories[row] >= 0)
+
+    score = weights['similarity'] * similarity + weights['freshness'] * freshness + weights['category'] * same_category
+    return candidates[np.argsort(-score, kind='stable')[:limit]]
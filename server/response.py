@@ -0,0 +1,79 @@
+import hashlib
+import orjson
+from bson import ObjectId
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Request, Response
+from fastapi.responses import ORJSONResponse
+from time import perf_counter
+from server.metrics import record_serialization
+
+
+def encode_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f'Type is not JSON serializable: {type(value).__name__}')
+
+
+class MongoJSONResponse(ORJSONResponse):
+    """
+    Encode projected Mongo documents directly with orjson (ObjectId as string, datetime as ISO 8601).
+
+    The endpoints return it instead of the models, so the documents are not validated
+    (their projection matches the response model) and FastAPI doesn't validate the response again.
+    """
+
+    def render(self, content) -> bytes:
+        start_time = perf_counter()
+        body = orjson.dumps(content, default=encode_default)
+        record_serialization(perf_counter() - start_time)
+        return body
+
+
+def make_etag(*parts):
+    """
+    Strong ETag of a response fully determined by the given parts (ids, generation, query parameters).
+    """
+
+    return '"' + hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:24] + '"'
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime = None):
+    """
+    Check the conditional headers of a GET request, If-None-Match has priority over If-Modified-Since.
+    """
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            return last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+def get_cache_headers(etag: str, cache_control: str, last_modified: datetime = None):
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(last_modified, usegmt=True)
+    return headers
+
+
+def cached_response(request: Request, content_function: callable, etag: str, cache_control: str,
+                    last_modified: datetime = None):
+    """
+    Answer 304 without computing the content if the client has the current version,
+    else encode content_function() with the cache headers.
+    """
+
+    headers = get_cache_headers(etag, cache_control, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    return MongoJSONResponse(content_function(), headers=headers)
@@ -0,0 +1,313 @@
+import numba
+import numpy as np
+from server.distance import sparse_combined_distance
+
+
+# the articles of the SHARD_MERGE_COUNT most recent shards get their neighbors from all of them,
+# the articles of the older shards keep the neighbors of their own shard
+SHARD_MERGE_COUNT = 3
+# beam size and number of entry rows of the search in another shard
+SEARCH_EF = 64
+SEARCH_ENTRIES = 16
+
+
+@numba.njit(cache=True)
+def insert_candidate(rows, distances, expanded, size, row, distance):
+    """
+    Insert a row in the beam sorted by distance, the farthest row is dropped when the beam is full.
+
+    Returns
+    ----------
+    int
+        The new size of the beam.
+    """
+
+    if size == rows.shape[0]:
+        if distance >= distances[size - 1]:
+            return size
+        size -= 1
+
+    position = size
+    while position > 0 and distances[position - 1] > distance:
+        rows[position] = rows[position - 1]
+        distances[position] = distances[position - 1]
+        expanded[position] = expanded[position - 1]
+        position -= 1
+
+    rows[position] = row
+    distances[position] = distance
+    expanded[position] = False
+    return size + 1
+
+
+@numba.njit(fastmath=True, cache=True)
+def hellinger_similarity(sqrt_query, indices, data):
+    """
+    Hellinger similarity of a sparse row (topic indices and values) to a query given as its dense normalized sqrt.
+    """
+
+    similarity = 0.0
+    norm = 0.0
+    for i in range(indices.shape[0]):
+        similarity += sqrt_query[indices[i]] * np.sqrt(data[i])
+        norm += data[i]
+    return similarity / np.sqrt(max(norm, 1e-30))
+
+
+@numba.njit(fastmath=True, cache=True)
+def row_distance(indptr, indices, data, dim, row, other):
+    """
+    combined_distance of two rows of the topic distributions stored as CSR arrays.
+    """
+
+    return sparse_combined_distance(
+        indices[indptr[row]:indptr[row + 1]], data[indptr[row]:indptr[row + 1]],
+        indices[indptr[other]:indptr[other + 1]], data[indptr[other]:indptr[other + 1]], dim
+    )
+
+
+@numba.njit(fastmath=True, cache=True)
+def search_graph(graph, rows, indptr, indices, data, dim, query, k, ef, entries):
+    """
+    Greedy beam search of the k nearest rows of a shard to the row query on the neighbor graph of the shard,
+    from entries evenly spaced rows. rows maps the local rows to the rows of the topic distributions (CSR arrays),
+    the local rows of the removed articles (-1) are skipped. The beam is searched with the Hellinger distance
+    (much cheaper, as the first stage of the graph build) then sorted by combined_distance.
+
+    Returns
+    ----------
+    tuple[np.ndarray, np.ndarray]
+        The local rows and their combined_distance sorted by distance (-1 and inf if the shard has less than k rows).
+    """
+
+    ef = max(ef, k)
+    beam = np.full(ef, -1, dtype=np.int64)
+    distances = np.full(ef, np.inf, dtype=np.float32)
+    expanded = np.zeros(ef, dtype=np.bool_)
+    visited = np.zeros(graph.shape[0], dtype=np.bool_)
+    size = 0
+
+    query_indices = indices[indptr[query]:indptr[query + 1]]
+    query_data = data[indptr[query]:indptr[query + 1]]
+    total = max(query_data.sum(), 1e-30)
+    sqrt_query = np.zeros(dim, dtype=np.float32)
+    for i in range(query_indices.shape[0]):
+        sqrt_query[query_indices[i]] = np.sqrt(max(query_data[i], 0) / total)
+
+    for local_row in range(0, graph.shape[0], max(graph.shape[0] // entries, 1)):
+        visited[local_row] = True
+        row = rows[local_row]
+        if row >= 0:
+            distance = -hellinger_similarity(
+                sqrt_query, indices[indptr[row]:indptr[row + 1]], data[indptr[row]:indptr[row + 1]]
+            )
+            size = insert_candidate(beam, distances, expanded, size, local_row, distance)
+
+    while True:
+        # expand the nearest row not expanded yet, stop when the beam doesn't change anymore
+        best = 0
+        while best < size and expanded[best]:
+            best += 1
+        if best == size:
+            break
+
+        expanded[best] = True
+        for neighbor in graph[beam[best]]:
+            if neighbor >= 0 and not visited[neighbor]:
+                visited[neighbor] = True
+                row = rows[neighbor]
+                if row >= 0:
+                    distance = -hellinger_similarity(
+                        sqrt_query, indices[indptr[row]:indptr[row + 1]], data[indptr[row]:indptr[row + 1]]
+                    )
+                    size = insert_candidate(beam, distances, expanded, size, neighbor, distance)
+
+    for i in range(size):
+        distances[i] = row_distance(indptr, indices, data, dim, query, rows[beam[i]])
+    order = np.argsort(distances, kind='mergesort')[:k]
+    return beam[order], distances[order]
+
+
+@numba.njit(parallel=True, cache=True)
+def batch_search_graph(graph, rows, indptr, indices, data, dim, queries, k, ef, entries):
+    """
+    search_graph of every query row.
+
+    Returns
+    ----------
+    tuple[np.ndarray, np.ndarray]
+        (n_queries, k) local rows and distances.
+    """
+
+    found = np.full((queries.shape[0], k), -1, dtype=np.int64)
+    distances = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+    for i in numba.prange(queries.shape[0]):
+        found_rows, found_distances = search_graph(graph, rows, indptr, indices, data, dim, queries[i], k, ef, entries)
+        found[i] = found_rows
+        distances[i] = found_distances
+
+    return found, distances
+
+
+@numba.njit(fastmath=True, cache=True)
+def neighbor_distances(graph, rows, indptr, indices, data, dim, local_row):
+    """
+    combined_distance of a local row to its neighbors in the graph of its shard,
+    inf for the missing neighbors (-1 or removed) and -1 for the row itself so it stays first.
+    """
+
+    distances = np.full(graph.shape[1], np.inf, dtype=np.float32)
+    for j in range(graph.shape[1]):
+        neighbor = graph[local_row, j]
+        if neighbor == local_row:
+            distances[j] = -1.0
+        elif neighbor >= 0 and rows[neighbor] >= 0:
+            distances[j] = row_distance(indptr, indices, data, dim, rows[local_row], rows[neighbor])
+
+    return distances
+
+
+@numba.njit(parallel=True, cache=True)
+def graph_distances(graph, rows, indptr, indices, data, dim, local_rows):
+    """
+    neighbor_distances of every local row.
+    """
+
+    distances = np.full((local_rows.shape[0], graph.shape[1]), np.inf, dtype=np.float32)
+    for i in numba.prange(local_rows.shape[0]):
+        distances[i] = neighbor_distances(graph, rows, indptr, indices, data, dim, local_rows[i])
+
+    return distances
+
+
+def get_topic_arrays(topics):
+    """
+    CSR arrays of the sparse topic distributions given to the kernels: (indptr, indices, data, dim).
+    """
+
+    return topics.indptr, topics.indices, topics.data, topics.shape[1]
+
+
+def get_recent_shards(shards: list[dict]):
+    return range(max(len(shards) - SHARD_MERGE_COUNT, 0), len(shards))
+
+
+def map_shard_rows(shard: dict, local_rows: np.ndarray):
+    """
+    Rows of the generation of local rows of a shard (-1 for the missing ones and the articles not in the generation).
+    """
+
+    local_rows = np.asarray(local_rows)
+    if len(shard['rows']) == 0:
+        return np.full(local_rows.shape, -1, dtype=np.int64)
+    return np.where(local_rows >= 0, shard['rows'][np.maximum(local_rows, 0)], -1)
+
+
+def sort_candidates(rows: list[np.ndarray], distances: list[np.ndarray], count: int):
+    """
+    Merge the candidate rows of the shards (rows of the generation) by distance.
+
+    Returns
+    ----------
+    np.ndarray
+        The count nearest candidates of every row (-1 for the missing ones).
+    """
+
+    rows = np.concatenate(rows, axis=1)
+    distances = np.where(rows >= 0, np.concatenate(distances, axis=1), np.inf)
+    order = np.argsort(distances, axis=1, kind='stable')[:, :count]
+    rows = np.take_along_axis(rows, order, axis=1)
+    return np.where(np.take_along_axis(distances, order, axis=1) < np.inf, rows, -1)
+
+
+def merge_shard_neighbors(shards: list[dict], topics, index: int, local_rows: np.ndarray, count: int):
+    """
+    Neighbors of local rows of the shard index merged across the recent shards: their neighbors in their own graph
+    and the count nearest rows of every other recent shard (search_graph), sorted by combined_distance
+    of the sparse topic distributions of the generation (csr_matrix).
+
+    Returns
+    ----------
+    np.ndarray
+        (len(local_rows), count) rows of the generation, the row itself first (-1 for the missing neighbors).
+    """
+
+    shard = shards[index]
+    arrays = get_topic_arrays(topics)
+    local_rows = np.asarray(local_rows, dtype=np.int64)
+    queries = shard['rows'][local_rows]
+    rows = [map_shard_rows(shard, shard['graph'][local_rows])]
+    distances = [graph_distances(shard['graph'], shard['rows'], *arrays, local_rows)]
+
+    for other_index in get_recent_shards(shards):
+        if other_index != index:
+            other = shards[other_index]
+            found_rows, found_distances = batch_search_graph(
+                other['graph'], other['rows'], *arrays, queries, count, SEARCH_EF, SEARCH_ENTRIES
+            )
+            rows.append(map_shard_rows(other, found_rows))
+            distances.append(found_distances)
+
+    return sort_candidates(rows, distances, count)
+
+
+def is_merged_shard(shards: list[dict], index: int):
+    return len(shards) > 1 and index in get_recent_shards(shards)
+
+
+def get_candidate_rows(current: dict, row: int, count: int):
+    """
+    Nearest rows of a row of the loaded generation (data.load_generation) ordered by similarity,
+    the row itself first then count neighbors at most (-1 for the missing ones).
+    The kernels are single threaded, the API runs the requests in a thread pool.
+    """
+
+    index = current['row_shards'][row]
+    if index < 0:
+        return np.array([], dtype=np.int64)
+
+    shards = current['shards']
+    shard = shards[index]
+    local_row = current['local_rows'][row]
+    if not is_merged_shard(shards, index):
+        return map_shard_rows(shard, shard['graph'][local_row][:count + 1])
+
+    arrays = get_topic_arrays(current['topics'])
+    rows = [map_shard_rows(shard, shard['graph'][local_row])]
+    distances = [neighbor_distances(shard['graph'], shard['rows'], *arrays, local_row)]
+    for other_index in get_recent_shards(shards):
+        if other_index != index:
+            other = shards[other_index]
+            found_rows, found_distances = search_graph(
+                other['graph'], other['rows'], *arrays, row, count + 1, SEARCH_EF, SEARCH_ENTRIES
+            )
+            rows.append(map_shard_rows(other, found_rows))
+            distances.append(found_distances)
+
+    return sort_candidates([found[None] for found in rows], [found[None] for found in distances], count + 1)[0]
+
+
+def merge_neighbor_graph(current: dict, n_neighbors: int):
+    """
+    Neighbor graph of every row of the loaded generation (data.load_generation) with the neighbors of get_candidate_rows.
+
+    Returns
+    ----------
+    np.ndarray
+        (n_rows, n_neighbors) rows of the generation, the row itself first (-1 for the missing neighbors).
+    """
+
+    graph = np.full((len(current['article_ids']), n_neighbors), -1, dtype=np.int64)
+    shards = current['shards']
+    for index, shard in enumerate(shards):
+        local_rows = np.flatnonzero(shard['rows'] >= 0)
+        if len(local_rows) == 0:
+            continue
+
+        if is_merged_shard(shards, index):
+            neighbors = merge_shard_neighbors(shards, current['topics'], index, local_rows, n_neighbors)
+        else:
+            neighbors = map_shard_rows(shard, shard['graph'][local_rows][:, :n_neighbors])
+        graph[shard['rows'][local_rows], :neighbors.shape[1]] = neighbors
+
+    return graph
@@ -1,12 +1,26 @@
 import numpy as np
-from pymongo import UpdateOne
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pymongo.errors import BulkWriteError
+from collections import Counter
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from time import perf_counter
 from crawler.database.dantri import DantriCrawler
 from crawler.database.vietnamnet import VietnamnetCrawler
 from crawler.database.vnexpress import VnexpressCrawler
 from crawler.database.vtcnews import VtcnewsCrawler
+from crawler import fetcher
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from server import data
+from server.distance import combined_distance, sparse_combined_distance
+from server.indexes import ensure_indexes
+from server.evaluation import compute_sampled_recall
+from server.instrumentation import UpdateRun
+from server.ranking import RERANK_OVERFETCH
+from server.shards import merge_neighbor_graph
 import random
 from gensim.models import LdaModel
 from gensim.corpora import Dictionary
@@ -14,146 +28,538 @@ from gensim.matutils import sparse2full
 import requests
 import numba
 from pynndescent import NNDescent
+from scipy.sparse import issparse
  
 
-FLOAT32_EPS = np.finfo(np.float32).eps
-FLOAT32_MAX = np.finfo(np.float32).max
-
-@numba.njit(fastmath=True)
-def combined_distance(x, y):
-    # prepare
-    dim = x.shape[0]
-    norm_x = 0.0
-    norm_y = 0.0
-    l1_norm_x = 0.0
-    l1_norm_y = 0.0
-    
-    for i in range(dim):
-        l1_norm_x += x[i]
-        l1_norm_y += y[i]
-        norm_x += x[i] ** 2
-        norm_y += y[i] ** 2
-
-    # cosine
-    if norm_x == 0.0 and norm_y == 0.0:
-        result_cos = 0.0
-    elif norm_x == 0.0 or norm_y == 0.0:
-        result_cos = 1.0
-    else:
-        result_cos = 0.0
-        for i in range(dim):
-            result_cos += x[i] * y[i]
-        result_cos = 1.0 - (result_cos / np.sqrt(norm_x * norm_y))
-        
-    # jensen shannon
-    result_jen = 0.0
-    l1_norm_x_jen = l1_norm_x + FLOAT32_EPS * dim
-    l1_norm_y_jen = l1_norm_y + FLOAT32_EPS * dim
-
-    pdf_x = (x + FLOAT32_EPS) / l1_norm_x_jen
-    pdf_y = (y + FLOAT32_EPS) / l1_norm_y_jen
-    m = 0.5 * (pdf_x + pdf_y)
-
-    for i in range(dim):
-        result_jen += 0.5 * (
-            pdf_x[i] * np.log(pdf_x[i] / m[i]) + pdf_y[i] * np.log(pdf_y[i] / m[i])
-        )
-        
-    # hellinger
-    if l1_norm_x == 0 and l1_norm_y == 0:
-        result_hel = 0.0
-    elif l1_norm_x == 0 or l1_norm_y == 0:
-        result_hel = 1.0
-    else:
-        result_hel = 0.0
-        for i in range(dim):
-            result_hel += np.sqrt(x[i] * y[i])
-        result_hel = np.sqrt(1 - result_hel / np.sqrt(l1_norm_x * l1_norm_y))
-        
-    # jaccard
-    if l1_norm_x == 0 and l1_norm_y == 0:
-        result_jac = 0.0
-    elif l1_norm_x == 0 or l1_norm_y == 0:
-        result_jac = 1.0
-    else:
-        intersection = 0.0
-        union = 0.0
-        for i in range(dim):
-            if x[i] <= y[i]:
-                intersection += x[i]
-                union += y[i]
-            else:
-                intersection += y[i]
-                union += x[i]
-        result_jac = 1 - intersection / union
-    
-    # combined
-    return (result_cos + result_jen + result_hel + result_jac) / 4
-
-
-def crawl_new_articles(vnexpress: bool, dantri: bool, vietnamnet: bool, vtcnews: bool, limit: int):    
+RECOMMENDATION_SIZE = 20
+N_NEIGHBORS = 30
+# graph of the recommendations: 'two_stage' (cheap candidates re-ranked with combined_distance)
+# or 'nndescent' (NNDescent with combined_distance)
+GRAPH_BUILD = os.getenv('GRAPH_BUILD', 'two_stage')
+CANDIDATE_HOPS = 2
+# graphs of fewer rows are exact (every row is a candidate of the second stage)
+EXACT_GRAPH_ROWS = 2000
+# seconds a crawl stage waits on a queue before checking if the run was stopped
+QUEUE_TIMEOUT = 1.0
+DUPLICATE_KEY_ERROR = 11000
+CRAWLERS = {
+    crawler.web_name: crawler
+    for crawler in [VnexpressCrawler, DantriCrawler, VietnamnetCrawler, VtcnewsCrawler]
+}
+
+
+def build_nndescent(topics) -> NNDescent:
+    """
+    Build the graph of the topic distributions in their stored representation
+    (data.compress_topic_distributions), sparse rows use sparse_combined_distance.
+    """
+
+    if issparse(topics):
+        return NNDescent(topics, metric=sparse_combined_distance, metric_kwds={'dim': topics.shape[1]})
+    return NNDescent(topics, metric=combined_distance)
+
+
+@numba.njit(parallel=True, cache=True)
+def expand_candidates(graph, hops):
+    """
+    Candidates of every row: its neighbors and the neighbors of its hops nearest neighbors (sorted, -1 padded).
+    """
+
+    n_neighbors = graph.shape[1]
+    candidates = np.full((graph.shape[0], n_neighbors * (hops + 1)), -1, dtype=np.int32)
+    for row in numba.prange(graph.shape[0]):
+        found = np.full(n_neighbors * (hops + 1), -1, dtype=np.int64)
+        found[:n_neighbors] = graph[row]
+        for hop in range(hops):
+            neighbor = graph[row, min(hop + 1, n_neighbors - 1)]
+            if neighbor >= 0:
+                found[n_neighbors * (hop + 1):n_neighbors * (hop + 2)] = graph[neighbor]
+
+        size = 0
+        for candidate in np.unique(found):
+            if candidate >= 0:
+                candidates[row, size] = candidate
+                size += 1
+
+    return candidates
+
+
+def build_candidate_graph(topics, n_neighbors=N_NEIGHBORS, hops=CANDIDATE_HOPS) -> np.ndarray:
+    """
+    First stage: neighbors by Hellinger distance, which is the cosine of the square roots of the distributions
+    (a builtin metric of NNDescent, much cheaper than combined_distance and its kernels are cached),
+    expanded with the neighbors of the nearest neighbors.
+    The rows are dense for this stage, NNDescent is slower on sparse rows.
+    """
+
+    vectors = np.sqrt(data.decompress_topic_distributions(topics))
+    graph = NNDescent(vectors, metric='cosine', n_neighbors=min(n_neighbors, vectors.shape[0])).neighbor_graph[0]
+    return expand_candidates(graph, hops)
+
+
+@numba.njit(parallel=True, cache=True)
+def rerank_candidates(matrix, candidates, n_neighbors):
+    """
+    Second stage: sort the candidates of every row by combined_distance and keep the n_neighbors first,
+    the row itself stays first (-1 for the missing neighbors).
+    """
+
+    graph = np.full((candidates.shape[0], n_neighbors), -1, dtype=np.int32)
+    for row in numba.prange(candidates.shape[0]):
+        distances = np.full(candidates.shape[1], np.inf, dtype=np.float32)
+        for j in range(candidates.shape[1]):
+            candidate = candidates[row, j]
+            if candidate == row:
+                distances[j] = -1.0
+            elif candidate >= 0:
+                distances[j] = combined_distance(matrix[row], matrix[candidate])
+
+        order = np.argsort(distances, kind='mergesort')
+        for j in range(min(n_neighbors, candidates.shape[1])):
+            if distances[order[j]] < np.inf:
+                graph[row, j] = candidates[row, order[j]]
+
+    return graph
+
+
+def build_neighbor_graph(topics, n_neighbors=N_NEIGHBORS, graph_build: str = None, candidate_hops=CANDIDATE_HOPS):
+    """
+    Neighbor graph of the stored topic distributions (data.compress_topic_distributions),
+    the first neighbor of a row is the row itself.
+    """
+
+    graph_build = graph_build or GRAPH_BUILD
+    if topics.shape[0] <= EXACT_GRAPH_ROWS:
+        candidates = np.tile(np.arange(topics.shape[0], dtype=np.int32), (topics.shape[0], 1))
+        return rerank_candidates(data.decompress_topic_distributions(topics), candidates, n_neighbors)
+    if graph_build == 'nndescent':
+        return build_nndescent(topics).neighbor_graph[0]
+    if graph_build == 'two_stage':
+        candidates = build_candidate_graph(topics, n_neighbors, candidate_hops)
+        return rerank_candidates(data.decompress_topic_distributions(topics), candidates, n_neighbors)
+
+    raise ValueError(f'Unknown graph build: {graph_build}')
+
+
+class StageTimer:
+    """
+    Busy time of every stage of the update pipeline, stages running in parallel
+    add up to more than the wall time. Also keep the crawl counters of every site/category.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self.crawl_counters = {}
+        self.lock = Lock()
+
+    def add(self, stage: str, seconds: float, count=1):
+        with self.lock:
+            self.times[stage] = self.times.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + count
+
+    def add_crawl_counters(self, web: str, category: str, counter: Counter):
+        with self.lock:
+            self.crawl_counters.setdefault(web, {}).setdefault(category, Counter()).update(counter)
+
+    def get_crawl_counters(self):
+        """
+        Returns
+        ----------
+        dict
+            {web: {category: {'listing', 'article', 'bytes', 'error', 'articles', 'black_list', ...}}}
+        """
+
+        return {
+            web: {category: dict(counter) for category, counter in categories.items()}
+            for web, categories in self.crawl_counters.items()
+        }
+
+    def report(self, wall_time: float = None):
+        print('Stage times (busy seconds / items)')
+        for stage, seconds in self.times.items():
+            print(f'{stage}: {seconds:.2f}s / {self.counts[stage]}')
+        if wall_time is not None:
+            print(f'Wall time: {wall_time:.2f}s')
+
+        return dict(self.times)
+
+
+def load_lda_model():
+    lda_model = LdaModel.load('data/lda_model/lda_model')
+    dictionary = Dictionary.load('data/lda_model/dictionary')
+    return lda_model, dictionary
+
+
+def preprocess_article(title: str, description: str, content: list):
+    """
+    Tokenize an article for the title duplication check and the LDA inference (run in a worker process).
+
+    Returns
+    ----------
+    tuple[str, list[str], float]
+        Processed title, tokens of the whole article and the executed time.
+    """
+
+    start_time = perf_counter()
+    title_tokens = data.process_sentence(title)
+    tokens = title_tokens + data.process_paragraph(description) + data.process_content(content)
+    return ' '.join(title_tokens), tokens, perf_counter() - start_time
+
+
+def put_item(queue: Queue, item, stop: Event):
+    """
+    Put an item in a bounded queue, give up when the run is stopped (the next stage doesn't read the queue anymore).
+
+    Returns
+    ----------
+    bool
+        True if the item was put.
+    """
+
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=QUEUE_TIMEOUT)
+            return True
+        except Full:
+            pass
+    return False
+
+
+class CrawlStageError(RuntimeError):
+    pass
+
+
+def get_item(queue: Queue, stop: Event, upstream: list[Thread] = None):
+    """
+    Get an item from a queue, None when the run is stopped.
+
+    Raises
+    ----------
+    CrawlStageError
+        If the threads putting the items (upstream) are all gone without their end sentinel.
+    """
+
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=QUEUE_TIMEOUT)
+        except Empty:
+            if upstream is not None and not any(thread.is_alive() for thread in upstream) and queue.empty():
+                raise CrawlStageError('The previous crawl stage stopped without finishing')
+    return None
+
+
+def produce_articles(crawler, limit: int, item_queue: Queue, stop: Event, run_id: str = None, timer: StageTimer = None):
+    """
+    Crawl every category of a news site into the queue, None is put when the crawler is done
+    (after an ('error', web name) item if it stopped early). The crawler stops when stop is set.
+
+    The requests of a site are only sent by its thread, the difference of its request counter
+    gives the requests of every category.
+    """
+
+    category = None
+    counter = Counter()
+    requests_before = Counter()
+    try:
+        known_ids = set()
+        for category in crawler.categories:
+            counter = Counter()
+            requests_before = Counter(fetcher.request_counter[crawler.web_name])
+            items = crawler.iter_articles(category, limit, known_ids, run_id=run_id)
+            while not stop.is_set():
+                start_time = perf_counter()
+                item = next(items, None)
+                if timer is not None:
+                    timer.add('crawl', perf_counter() - start_time, int(item is not None and item[0] == 'article'))
+                if item is None:
+                    break
+                if item[0] in ('article', 'black_list'):
+                    counter['articles' if item[0] == 'article' else 'black_list'] += 1
+                put_item(item_queue, item, stop)
+
+            if timer is not None:
+                timer.add_crawl_counters(
+                    crawler.web_name, category, counter + (fetcher.request_counter[crawler.web_name] - requests_before)
+                )
+    except Exception as e:
+        print(f'\nCrawler {crawler.web_name} stopped: {e}')
+        if timer is not None and category is not None:
+            category_requests = fetcher.request_counter[crawler.web_name] - requests_before
+            timer.add_crawl_counters(crawler.web_name, category, counter + category_requests + Counter(crawler_error=1))
+        put_item(item_queue, ('error', crawler.web_name), stop)
+    finally:
+        put_item(item_queue, None, stop)
+
+
+def tokenize_articles(item_queue: Queue, output_queue: Queue, pool: ProcessPoolExecutor, producers: list[Thread],
+                      stop: Event):
+    """
+    Send the crawled articles to the tokenizer processes as soon as they arrive,
+    the items are forwarded in order with the future of their tokens (None for the other items).
+    If the stage fails (e.g. the pool is broken by a killed worker), a ('stage_error', message, None) item is forwarded,
+    the end sentinel None is always forwarded.
+    """
+
+    try:
+        running_producers = len(producers)
+        while running_producers > 0:
+            item = get_item(item_queue, stop, producers)
+            if stop.is_set():
+                return
+            if item is None:
+                running_producers -= 1
+                continue
+
+            kind, document = item
+            future = None
+            if kind == 'article':
+                future = pool.submit(preprocess_article, document['title'], document['description'], document['content'])
+            put_item(output_queue, (kind, document, future), stop)
+    except Exception as e:
+        print(f'\nTokenize stage stopped: {e!r}')
+        put_item(output_queue, ('stage_error', f'tokenize: {e!r}', None), stop)
+    finally:
+        put_item(output_queue, None, stop)
+
+
+def infer_topics(item_queue: Queue, output_queue: Queue, lda_model: LdaModel, dictionary: Dictionary,
+                 timer: StageTimer, tokenizer: Thread, stop: Event):
+    """
+    Add the processed title and the topic distribution to the tokenized articles.
+    If the tokenization failed, the article is processed again by the update steps.
+    If the stage fails, a ('stage_error', message) item is forwarded, the end sentinel None is always forwarded.
+    """
+
+    try:
+        while True:
+            item = get_item(item_queue, stop, [tokenizer])
+            if stop.is_set() or item is None:
+                return
+
+            kind, document, future = item
+            if future is not None:
+                try:
+                    processed_title, tokens, executed_time = future.result()
+                    timer.add('tokenize', executed_time)
+
+                    start_time = perf_counter()
+                    bow = dictionary.doc2bow(tokens)
+                    document['processed_title'] = processed_title
+                    document['topic_distribution'] = sparse2full(lda_model[bow], lda_model.num_topics).tolist()
+                    timer.add('inference', perf_counter() - start_time)
+                except Exception as e:
+                    print(f"\nPreprocess failed for {document['link']}: {e}")
+
+            put_item(output_queue, (kind, document), stop)
+    except Exception as e:
+        print(f'\nInference stage stopped: {e!r}')
+        put_item(output_queue, ('stage_error', f'inference: {e!r}'), stop)
+    finally:
+        put_item(output_queue, None, stop)
+
+
+def insert_documents(collection, documents: list):
+    """
+    Insert documents unordered, the ones already stored (duplicate key, by an interrupted run) count as stored.
+
+    Returns
+    ----------
+    tuple[int, list[dict], BulkWriteError | None]
+        Number of inserted documents, the stored documents and the error of the rejected ones (None if there is none).
+    """
+
+    if len(documents) == 0:
+        return 0, [], None
+
+    try:
+        return len(collection.insert_many(documents, ordered=False).inserted_ids), documents, None
+    except BulkWriteError as e:
+        rejected = {error['index'] for error in e.details['writeErrors'] if error['code'] != DUPLICATE_KEY_ERROR}
+        stored = [document for i, document in enumerate(documents) if i not in rejected]
+        return e.details['nInserted'], stored, e if len(rejected) > 0 else None
+
+
+def flush_articles(db, articles: list, black_list: list):
+    """
+    Bulk insert a batch of crawled documents, mark the links of the stored ones as done in the crawl frontier
+    then clear the lists.
+
+    Returns
+    ----------
+    int
+        Number of inserted articles, the ones already stored by an interrupted run are skipped.
+
+    Raises
+    ----------
+    BulkWriteError
+        If a document was rejected for another reason than a duplicate key, its link stays pending in the frontier.
+    """
+
+    random.shuffle(articles)
+    inserted, stored_articles, article_error = insert_documents(db['temporary_newspaper'], articles)
+    _, stored_black_list, black_list_error = insert_documents(db['black_list'], black_list)
+
+    done_ids = {}
+    for document in stored_articles + stored_black_list:
+        done_ids.setdefault(document['web'], []).append(document['link_id'])
+    for web, link_ids in done_ids.items():
+        data.mark_frontier_done(web, link_ids)
+
+    articles.clear()
+    black_list.clear()
+    if article_error is not None or black_list_error is not None:
+        raise article_error or black_list_error
+    return inserted
+
+
+def prepare_collections():
+    """
+    Backfill the link ids of the documents stored before the link_id field existed, then create the indexes:
+    the unique (web, link_id) index can't be built while several legacy documents have no link_id.
+    """
+
+    for crawler in CRAWLERS.values():
+        data.backfill_link_ids(crawler.web_name, crawler.extract_id)
+    ensure_indexes()
+
+
+def crawl_new_articles(vnexpress: bool, dantri: bool, vietnamnet: bool, vtcnews: bool, limit: int,
+                       batch_size=100, queue_size=500, workers: int = None, run: UpdateRun = None):
+    """
+    Crawl the news sites, preprocess the articles and stream them into temporary_newspaper.
+
+    Every article flows through the stages as soon as it is crawled:
+    crawl (one thread per site) -> tokenize (process pool) -> LDA inference (one thread) -> write (calling thread).
+    The stages are connected by bounded queues, the articles are written in batches of batch_size
+    with their processed title and topic distribution, so the update steps don't have to process them again.
+
+    The crawl state of a category is only saved after all its articles are written.
+    The found links are kept in the crawl frontier until they are stored, an interrupted run is resumed
+    by the next call (same run id) which only crawls the remaining links.
+
+    If writing or a stage fails (or a stage thread is gone), the run fails with the error:
+    the other stages are stopped (their threads exit and the process pool is shut down) before it is raised.
+
+    The busy time of the stages and the crawl counters are added to run.
+
+    Returns
+    ----------
+    dict
+        Busy time of every stage.
+    """
+
+    start_time = perf_counter()
+    timer = StageTimer()
+    fetcher.reset_request_counter()
+    prepare_collections()
+    lda_model, dictionary = load_lda_model()
+
+    crawlers = [
+        crawler for crawler, enabled in zip(
+            [VnexpressCrawler, DantriCrawler, VietnamnetCrawler, VtcnewsCrawler],
+            [vnexpress, dantri, vietnamnet, vtcnews]
+        ) if enabled
+    ]
+    run_id = data.start_crawl_run()
+    crawl_queue = Queue(maxsize=queue_size)
+    tokenize_queue = Queue(maxsize=queue_size)
+    item_queue = Queue(maxsize=queue_size)
+    stop = Event()
+
+    # spawn, the workers must not inherit the crawler threads and the mongo clients.
+    # The workers are started (and load the tokenizer) while the first listing pages are crawled
+    workers = workers or os.cpu_count()
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    for _ in range(workers):
+        pool.submit(preprocess_article, '', '', [])
+    producers = [
+        Thread(target=produce_articles, args=(crawler, limit, crawl_queue, stop, run_id, timer), daemon=True)
+        for crawler in crawlers
+    ]
+    tokenizer = Thread(target=tokenize_articles, args=(crawl_queue, tokenize_queue, pool, producers, stop), daemon=True)
+    inference = Thread(
+        target=infer_topics, args=(tokenize_queue, item_queue, lda_model, dictionary, timer, tokenizer, stop), daemon=True
+    )
+    for thread in producers + [tokenizer, inference]:
+        thread.start()
+
+    failed_crawlers = []
     articles = []
     black_list = []
-                
-    if vnexpress:
-        for category in VnexpressCrawler.categories:
-            temp_articles, temp_black_list = VnexpressCrawler.crawl_articles(category, limit)
-            articles.extend(temp_articles)
-            black_list.extend(
-                [{"link": link, "web": VnexpressCrawler.web_name} for link in temp_black_list]
-            )
-
-    if dantri:
-        for category in DantriCrawler.categories:
-            temp_articles, temp_black_list = DantriCrawler.crawl_articles(category, limit)
-            articles.extend(temp_articles)
-            black_list.extend(
-                [{"link": link, "web": DantriCrawler.web_name} for link in temp_black_list]
-            )
-
-    if vietnamnet:
-        for category in VietnamnetCrawler.categories:
-            temp_articles, temp_black_list = VietnamnetCrawler.crawl_articles(category, limit)
-            articles.extend(temp_articles)
-            black_list.extend(
-                [{"link": link, "web": VietnamnetCrawler.web_name} for link in temp_black_list]
-            )
-
-    if vtcnews:
-        for category in VtcnewsCrawler.categories:
-            temp_articles, temp_black_list = VtcnewsCrawler.crawl_articles(category, limit)
-            articles.extend(temp_articles)
-            black_list.extend(
-                [{"link": link, "web": VtcnewsCrawler.web_name} for link in temp_black_list]
-            )
 
-    with data.connect_to_mongo() as client:
-        db = client['Ganesha_News']
-
-        if len(articles) > 0:
-            random.shuffle(articles)
-            collection = db['temporary_newspaper']
-            collection.insert_many(articles)
-            
-        if len(black_list) > 0:
-            black_collection = db['black_list']
-            black_collection.insert_many(black_list)
+    def write():
+        write_start_time = perf_counter()
+        inserted = flush_articles(db, articles, black_list)
+        timer.add('write', perf_counter() - write_start_time, inserted)
+
+    try:
+        with data.connect_to_mongo() as client:
+            db = client['Ganesha_News']
+
+            while True:
+                item = get_item(item_queue, stop, [inference])
+                if item is None:
+                    break
+
+                kind, document = item
+                if kind == 'stage_error':
+                    raise CrawlStageError(document)
+                elif kind == 'article':
+                    articles.append(document)
+                elif kind == 'black_list':
+                    black_list.append(document)
+                elif kind == 'error':
+                    failed_crawlers.append(document)
+                else:
+                    # everything crawled before the checkpoint must be stored before saving it
+                    write()
+                    data.save_crawl_state(document['web'], document['category'], document)
+
+                if len(articles) + len(black_list) >= batch_size:
+                    write()
+
+            write()
+    finally:
+        # no-op after a complete run, otherwise unblock the stages waiting on the queues nobody reads anymore
+        stop.set()
+        pool.shutdown(cancel_futures=True)
+
+    # the run is resumed next time if a crawler stopped early
+    if len(failed_crawlers) == 0:
+        data.finish_crawl_run(run_id)
+    else:
+        print(f"Crawl run {run_id} is unfinished: {', '.join(failed_crawlers)} stopped early")
 
     print(f"\nCrawl {data.total_documents('temporary_newspaper')} new articles!\n")
-
-
-def check_duplicated_titles(similarity_threshold=0.75, time_threshold_in_days=1.5):
-    # load database (old) and newly crawled articles
-    old_articles = data.get_titles('newspaper')
+    requests_report = fetcher.report_requests()
+    stage_times = timer.report(perf_counter() - start_time)
+    if run is not None:
+        run.add_counters('crawl', {
+            'stages': {stage: {'seconds': seconds, 'items': timer.counts[stage]} for stage, seconds in stage_times.items()},
+            'requests': requests_report,
+            'sites': timer.get_crawl_counters(),
+            'failed_crawlers': failed_crawlers,
+        })
+    return stage_times
+
+
+def check_duplicated_titles(generation: int, similarity_threshold=0.75, time_threshold_in_days=1.5):
+    # load the published (old) articles in the row order of their generation and newly crawled articles
+    published_generation = data.get_published_generation()
+    old_ids = data.load_article_ids(published_generation)
+    old_articles = {doc['_id']: doc for doc in data.get_titles('newspaper')}
+    old_articles = [old_articles[article_id] for article_id in old_ids]
     new_articles = data.get_titles('temporary_newspaper')
     articles = old_articles + new_articles
-    last_database_index = len(old_articles)
-    if last_database_index == 0:
-        last_database_index = -1
+    last_database_index = len(old_articles) - 1
     
     print('Preprocessing titles')
-    old_titles = data.load_processed_titles()    
-    new_titles = [data.process_title(doc['title']) for doc in new_articles]
+    old_titles = data.load_processed_titles(published_generation)
+    new_titles = [
+        doc['processed_title'] if 'processed_title' in doc else data.process_title(doc['title'])
+        for doc in new_articles
+    ]
     titles = old_titles + new_titles
     vectorizer = TfidfVectorizer(lowercase=False)
     tfidf_matrix = vectorizer.fit_transform(titles)
@@ -196,7 +602,12 @@ def check_duplicated_titles(similarity_threshold=0.75, time_threshold_in_days=1.
     old_dup_index = [int(id) for id in dup_index if id <= last_database_index]
     new_dup_id = [articles[id]['_id'] for id in dup_index if id > last_database_index]
     black_list = [
-        {"link": articles[id]['link'], "web": articles[id]['web']} for id in dup_index
+        {
+            "link": articles[id]['link'],
+            "web": articles[id]['web'],
+            "link_id": CRAWLERS[articles[id]['web']].extract_id(articles[id]['link'])
+        }
+        for id in dup_index
     ]
 
     with data.connect_to_mongo() as client:
@@ -205,20 +616,14 @@ def check_duplicated_titles(similarity_threshold=0.75, time_threshold_in_days=1.
         temp_collection = db['temporary_newspaper']
         b_collection = db['black_list']
     
+        # the published articles are only deleted once the new generation is published
         if len(old_dup_index) > 0:
-            result = collection.delete_many({'index': {'$in': old_dup_index}})
-            print(f'Deleted {result.deleted_count} duplicated documents from database')
-            
-            bulk_updates = []
-            for i, doc in enumerate(list(collection.find({}, {"_id": 1}))):
-                bulk_updates.append(
-                    UpdateOne(
-                        {"_id": doc["_id"]},
-                        {"$set": {"index": i}}
-                    )
-                )
-            result = collection.bulk_write(bulk_updates)
-            print(f'Reset index')
+            retired_ids = [old_ids[i] for i in old_dup_index]
+            result = collection.update_many(
+                {'_id': {'$in': retired_ids}},
+                {'$set': {'retired_generation': generation}}
+            )
+            print(f'Retired {result.modified_count} duplicated documents from database')
 
         if len(new_dup_id) > 0:
             result = temp_collection.delete_many({'_id': {'$in': new_dup_id}})
@@ -228,78 +633,261 @@ def check_duplicated_titles(similarity_threshold=0.75, time_threshold_in_days=1.
             result = b_collection.insert_many(black_list)
             print(f'Added {len(result.inserted_ids)} black list document')
             
-    # Update processed titles list
+    # Save the processed titles, topic distributions and articles of the new generation
     titles = [title for i, title in enumerate(titles) if i not in dup_index]
-    data.save_processed_titles(titles)
+    data.save_processed_titles(titles, generation)
 
-    # Update saved topic distributions
-    topic_distributions = data.load_topic_distributions()
+    topic_distributions = data.load_topic_distributions(generation=published_generation)
     topic_distributions = np.array([row for i, row in enumerate(topic_distributions) if i not in old_dup_index])
-    data.save_topic_distributions(topic_distributions)
+    data.save_topic_distributions(topic_distributions, generation)
 
+    data.save_article_ids([article_id for i, article_id in enumerate(old_ids) if i not in old_dup_index], generation)
 
-def update_nndescent_index():
-    print('Load LDA model')
-    lda_model = LdaModel.load('data/lda_model/lda_model')
-    dictionary = Dictionary.load('data/lda_model/dictionary')
-    
-    print('Processing document content')
-    processed_documents = []
+
+def update_nndescent_index(generation: int):
+    # the topic distributions are predicted by the crawl pipeline, only the missing ones are predicted here
     article_content = data.get_content('temporary_newspaper')
-    for doc in article_content:
-        title = data.process_sentence(doc['title'])
-        description = data.process_paragraph(doc['description'])
-        content = data.process_content(doc['content'])
-        processed_documents.append(title + description + content)
-        
-    print('Predicting topic distributions')
-    corpus = [dictionary.doc2bow(doc) for doc in processed_documents]
-    lda_corpus = lda_model[corpus]
-    new_topic_distributions = np.array([sparse2full(vec, lda_model.num_topics) for vec in lda_corpus])
-    old_topic_distributions = data.load_topic_distributions()
+    new_topic_distributions = [doc.get('topic_distribution') for doc in article_content]
+    missing_index = [i for i, row in enumerate(new_topic_distributions) if row is None]
+
+    if len(missing_index) > 0:
+        print('Load LDA model')
+        lda_model, dictionary = load_lda_model()
+
+        print(f'Processing document content of {len(missing_index)} articles')
+        processed_documents = []
+        for i in missing_index:
+            doc = article_content[i]
+            title = data.process_sentence(doc['title'])
+            description = data.process_paragraph(doc['description'])
+            content = data.process_content(doc['content'])
+            processed_documents.append(title + description + content)
+
+        print('Predicting topic distributions')
+        corpus = [dictionary.doc2bow(doc) for doc in processed_documents]
+        lda_corpus = lda_model[corpus]
+        for i, vec in zip(missing_index, lda_corpus):
+            new_topic_distributions[i] = sparse2full(vec, lda_model.num_topics)
+
+    new_topic_distributions = np.array(new_topic_distributions, dtype=np.float32)
+    old_topic_distributions = data.load_topic_distributions(generation=generation)
     if old_topic_distributions.shape[0] == 0:
         topic_distributions = new_topic_distributions
     else:
         topic_distributions = np.vstack((old_topic_distributions, new_topic_distributions))
-    data.save_topic_distributions(topic_distributions)
-
-    print('Updating nndescent index')
-    nndescent = NNDescent(topic_distributions, metric=combined_distance)
-    data.save_neighbor_graph(nndescent.neighbor_graph[0])
-
+    data.save_topic_distributions(topic_distributions, generation)
+    data.save_article_ids(data.load_article_ids(generation) + [doc['_id'] for doc in article_content], generation)
+
+    # month of the articles without a shard: the new ones, every article the first time the graph is partitioned
+    published_months = {doc['_id']: f"{doc['published_date']:%Y-%m}" for doc in article_content}
+    published_generation = data.get_published_generation()
+    if data.load_shard_manifest(published_generation) is None:
+        published_dates = data.load_article_columns(published_generation)['published_dates']
+        months = published_dates.astype('datetime64[s]').astype('datetime64[M]').astype(str)
+        published_months.update(zip(data.load_article_ids(published_generation), months))
+
+    return update_shards(generation, data.load_article_ids(generation), topic_distributions, published_months)
+
+
+def update_shards(generation: int, article_ids: list, topic_distributions: np.ndarray, published_months: dict):
+    """
+    Partition the neighbor graph of the generation by published month, so an update doesn't rebuild
+    the graph of every article ever crawled: every month has its own graph and only the open shards that changed
+    (the current month, the previous one until its first update of the new month) are rebuilt.
+    The shards of the past months are frozen once they are written (data.SHARD_DIR) and never change,
+    the new articles of a frozen month go to the shard of the current month.
+    The API merges the neighbors of the recent shards at query time (shards.get_candidate_rows).
+
+    Parameters
+    ----------
+    published_months : dict
+        {article_id: 'YYYY-MM'} of the articles not in a shard yet.
+
+    Returns
+    ----------
+    dict
+        Counters of the update: the rebuilt shards and the recall of the shard of the current month.
+    """
+
+    published_generation = data.get_published_generation()
+    article_keys = data.get_article_keys(article_ids)
+    previous_shards = data.load_shard_manifest(published_generation) or []
+    frozen_shards = [entry for entry in previous_shards if entry['frozen']]
+    current_month = max([*published_months.values(), *(entry['month'] for entry in previous_shards)])
+
+    # rows of the open shards (without the removed articles) then the new rows
+    shard_rows = {}
+    previous_rows = {}
+    for entry in previous_shards:
+        if not entry['frozen']:
+            shard = data.load_shard(entry, published_generation, article_keys)
+            shard_rows[entry['month']] = [int(row) for row in shard['rows'] if row >= 0]
+            previous_rows[entry['month']] = (shard['rows'], shard['graph'])
+
+    open_months = set(shard_rows) | {current_month}
+    for row, article_id in enumerate(article_ids):
+        month = published_months.get(article_id)
+        if month is not None:
+            if len(previous_shards) > 0 and month not in open_months:
+                month = current_month
+            shard_rows.setdefault(month, []).append(row)
+
+    shards = list(frozen_shards)
+    rebuilt = {}
+    recall = None
+    for month, rows in sorted(shard_rows.items()):
+        rows = np.array(rows, dtype=np.int64)
+        if len(rows) == 0:
+            continue
+
+        frozen = month < current_month
+        local_rows, graph = previous_rows.get(month, (None, None))
+        if local_rows is None or not np.array_equal(local_rows, rows):
+            print(f'Updating neighbor graph of {month} ({len(rows)} articles, {GRAPH_BUILD}, {data.TOPIC_STORAGE} topics)')
+            graph = build_neighbor_graph(data.compress_topic_distributions(topic_distributions[rows]))
+            rebuilt[month] = len(rows)
+            if month == current_month:
+                # quality of the graph against the exact neighbors of sampled articles
+                recall = compute_sampled_recall(graph, topic_distributions[rows], combined_distance, k=RECOMMENDATION_SIZE)
+                print(f'Recall@{RECOMMENDATION_SIZE} of sampled articles: {recall:.3f}')
+
+        data.save_shard(month, article_keys[rows], np.asarray(graph), None if frozen else generation)
+        shards.append({'month': month, 'frozen': frozen, 'rows': len(rows)})
+
+    shards.sort(key=lambda entry: entry['month'])
+    data.save_shard_manifest(shards, generation)
+    print(f'{len(shards)} shards, rebuilt: {rebuilt}')
+    return {'graph_build': GRAPH_BUILD, 'topic_storage': data.TOPIC_STORAGE, 'rows': len(article_ids),
+            'shards': len(shards), 'rebuilt_shards': rebuilt, f'recall@{RECOMMENDATION_SIZE}': recall}
+
+
+def update_database(generation: int):
+    """
+    Copy the crawled articles to the database, tagged with their generation they are only served
+    once the generation is published (temporary_newspaper is cleaned after the publish).
+    """
 
-def update_database():
     with data.connect_to_mongo() as client:
         db = client['Ganesha_News']
         collection = db['newspaper']
         temp_collection = db['temporary_newspaper']
-        articles = list(temp_collection.find({}, {"_id": 0}))
+        articles = list(temp_collection.find({}, {"processed_title": 0, "topic_distribution": 0}))
 
-        index = data.total_documents('newspaper')
         for article in articles:
-            article['index'] = index
-            index += 1
+            article['generation'] = generation
 
         result = collection.insert_many(articles)
         print(f'Copy {len(result.inserted_ids)} articles to original database')
-        temp_collection.drop()
+
+    # every article of the generation is in the database now
+    data.save_article_columns(generation)
+
+
+def update_recommendations(generation: int, top_n=RECOMMENDATION_SIZE * RERANK_OVERFETCH):
+    """
+    Materialize the top_n recommendations of every article of the generation with their ShortArticle fields,
+    the API re-ranks up to RERANK_OVERFETCH times the returned recommendations so they are all stored.
+
+    The neighbors of every article are computed again (merge_neighbor_graph, the frozen shards only read their graph),
+    only the writes are incremental: the articles whose recommendations changed get a new document
+    (tagged with the generation), the API reads the latest document of an article up to the published generation.
+    The replaced documents are marked superseded and deleted after the publish.
+    """
+
+    current = data.load_generation(generation)
+    graph = merge_neighbor_graph(current, top_n + 1)
+    article_ids = current['article_ids']
+
+    with data.connect_to_mongo() as client:
+        db = client['Ganesha_News']
+        collection = db['recommendations']
+
+        # current recommendations of the published generation
+        published_generation = data.get_published_generation(db)
+        published_lists = {}
+        query = {"generation": {"$lte": published_generation}}
+        for doc in collection.find(query, {"article_id": 1, "generation": 1, "neighbors": 1}).sort("generation", 1):
+            published_lists[doc['article_id']] = doc['neighbors']
+
+        changed = {}
+        for row, neighbors in enumerate(graph):
+            recommendation_ids = [article_ids[int(index)] for index in neighbors[1 : top_n + 1] if index >= 0]
+            if published_lists.get(article_ids[row]) != recommendation_ids:
+                changed[article_ids[row]] = recommendation_ids
+
+        removed_ids = list(set(published_lists.keys()) - set(article_ids))
+        print(f'Update recommendations of {len(changed)} / {len(article_ids)} articles')
+        if len(changed) == 0 and len(removed_ids) == 0:
+            return
+
+        needed_ids = list({article_id for ids in changed.values() for article_id in ids})
+        fields = {"title": 1, "description": 1, "thumbnail": 1}
+        short_articles = {doc['_id']: doc for doc in db['newspaper'].find({"_id": {"$in": needed_ids}}, fields)}
+
+        collection.update_many(
+            {"article_id": {"$in": list(changed.keys()) + removed_ids}, "generation": {"$lt": generation}},
+            {"$set": {"superseded_by": generation}}
+        )
+        if len(changed) > 0:
+            collection.insert_many([
+                {
+                    "article_id": article_id,
+                    "generation": generation,
+                    "neighbors": recommendation_ids,
+                    "articles": [short_articles[id] for id in recommendation_ids if id in short_articles]
+                }
+                for article_id, recommendation_ids in changed.items()
+            ], ordered=False)
 
 
 def update_new_articles(vnexpress=True, dantri=True, vietnamnet=True, vtcnews=True, limit=10 ** 9):
-    print('\nStep 1: Crawl new articles')
-    crawl_new_articles(vnexpress, dantri, vietnamnet, vtcnews, limit)
+    """
+    Prepare the next generation: the model files are written under the generation
+    and the articles tagged with it, nothing is served before data.publish_update(generation).
+    The time, peak memory and counters of every step are recorded by an UpdateRun.
+
+    Returns
+    ----------
+    int | None
+        The generation to publish, None if there is no new article.
+    """
+
+    generation = data.clean_generations() + 1
+    run = UpdateRun(generation)
+    status = 'failed'
+
+    try:
+        print('\nStep 1: Crawl and preprocess new articles')
+        with run.stage('crawl'):
+            crawl_new_articles(vnexpress, dantri, vietnamnet, vtcnews, limit, run=run)
+
+        if data.is_collection_empty_or_not_exist('temporary_newspaper'):
+            print('No new articles have been found')
+            status = 'no_articles'
+            return None
+        run.add_counters('articles', {'new': data.total_documents('temporary_newspaper')})
 
-    if data.is_collection_empty_or_not_exist('temporary_newspaper'):
-        print('No new articles have been found')
-    else:
         print('\nStep 2: Check for duplicated titles')
-        check_duplicated_titles()
+        with run.stage('dedup'):
+            check_duplicated_titles(generation)
 
         print('\nStep 3: Update ANN model')
-        update_nndescent_index()
-        
-        print('\nStep 4: Update database')
-        update_database()
-
-    return data.load_neighbor_graph()
+        with run.stage('nndescent'):
+            run.add_counters('graph', update_nndescent_index(generation))
 
+        print('\nStep 4: Update database')
+        with run.stage('database'):
+            update_database(generation)
+
+        print('\nStep 5: Update recommendations')
+        with run.stage('recommendations'):
+            update_recommendations(generation)
+
+        status = 'prepared'
+        return generation
+    finally:
+        # the run summary is only metrics, failing to store it must not hide the error of the update
+        try:
+            run.finish(status)
+        except Exception as error:
+            print(f'Failed to save the summary of the update run {run.run_id}: {error!r}')
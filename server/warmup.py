@@ -0,0 +1,64 @@
+import numpy as np
+from time import perf_counter
+from numba.core import event
+from server import data
+from server.evaluation import compute_sampled_recall
+from server.shards import get_candidate_rows
+from server.updater import EXACT_GRAPH_ROWS, build_neighbor_graph, combined_distance
+
+
+# the graph of a smaller matrix is exact, it wouldn't compile the NNDescent kernels
+WARMUP_ROWS = 2 * EXACT_GRAPH_ROWS
+WARMUP_TOPICS = 25
+
+
+def warmup(rows=WARMUP_ROWS, num_topics=WARMUP_TOPICS):
+    """
+    Compile the kernels of the neighbor graph build (updater.GRAPH_BUILD with data.TOPIC_STORAGE)
+    and of its recall check before the first update, with a build on a small random topic matrix.
+
+    combined_distance and the pynndescent kernels marked cache=True are written to the numba cache
+    (__pycache__, or NUMBA_CACHE_DIR), run at image build time the next processes load them from disk.
+    The kernels pynndescent specializes for a custom metric can't be cached, they are compiled again
+    by every process (the warmup at the start of the worker).
+    The search of the shards is compiled for memory mapped (read only) and loaded graphs, as used by the API.
+
+    Returns
+    ----------
+    dict
+        {'seconds': warmup time, 'compile_seconds': numba compilation time}
+    """
+
+    compile_times = []
+    start_time = perf_counter()
+    with event.install_timer('numba:compile', compile_times.append):
+        rng = np.random.default_rng(0)
+        matrix = rng.dirichlet(np.full(num_topics, 0.1), rows).astype(np.float32)
+        topics = data.compress_topic_distributions(matrix)
+        combined_distance(matrix[0], matrix[1])
+        neighbor_graph = build_neighbor_graph(topics)
+        compute_sampled_recall(neighbor_graph, matrix, combined_distance, sample_size=10)
+
+        # a frozen (read only) shard and an open shard of the first rows
+        shard_rows = [np.arange(0, EXACT_GRAPH_ROWS // 2), np.arange(EXACT_GRAPH_ROWS // 2, EXACT_GRAPH_ROWS)]
+        shards = []
+        for rows, frozen in zip(shard_rows, [True, False]):
+            graph = build_neighbor_graph(data.compress_topic_distributions(matrix[rows]))
+            graph.flags.writeable = not frozen
+            shards.append({'frozen': frozen, 'graph': graph, 'rows': rows})
+        current = {
+            'topics': data.to_sparse_topic_distributions(topics),
+            'shards': shards,
+            'row_shards': np.repeat(np.arange(len(shards), dtype=np.int32), [len(rows) for rows in shard_rows]),
+            'local_rows': np.concatenate([np.arange(len(rows)) for rows in shard_rows]),
+        }
+        for rows in shard_rows:
+            get_candidate_rows(current, int(rows[0]), 10)
+
+    result = {'seconds': perf_counter() - start_time, 'compile_seconds': sum(compile_times)}
+    print(f"Numba warmup: {result['seconds']:.2f}s, compilation: {result['compile_seconds']:.2f}s")
+    return result
+
+
+if __name__ == '__main__':
+    warmup()
@@ -0,0 +1,204 @@
+import os
+import socket
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from time import sleep
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from server import data
+from server.updater import prepare_collections, update_new_articles
+from server.warmup import warmup
+
+
+LOCK_LEASE_SECONDS = 10 * 60
+UPDATE_INTERVAL_HOURS = 24
+
+
+def get_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+def enqueue_update(**params):
+    """
+    Add an update job to the queue, nothing is added if a job is already waiting.
+
+    Parameters
+    ----------
+    params : dict
+        Keyword arguments of update_new_articles.
+
+    Returns
+    ----------
+    ObjectId | None
+        Id of the new job.
+    """
+
+    with data.connect_to_mongo() as client:
+        db = client['Ganesha_News']
+        if db['update_jobs'].find_one({"status": "queued"}) is not None:
+            return None
+
+        job = {"status": "queued", "params": params, "created_at": datetime.now()}
+        return db['update_jobs'].insert_one(job).inserted_id
+
+
+def schedule_update(interval_hours=UPDATE_INTERVAL_HOURS):
+    """
+    Enqueue the periodic update if no job was created during the last interval.
+    """
+
+    with data.connect_to_mongo() as client:
+        db = client['Ganesha_News']
+        since = datetime.now() - timedelta(hours=interval_hours)
+        if db['update_jobs'].find_one({"created_at": {"$gte": since}}) is not None:
+            return None
+
+    return enqueue_update()
+
+
+def acquire_update_lock(owner: str, lease_seconds=LOCK_LEASE_SECONDS):
+    """
+    Take (or renew) the update lock, only one update can run at a time.
+    The lock is a lease, it's released by itself if the worker dies.
+
+    Returns
+    ----------
+    bool
+        True if the lock is held by the owner.
+    """
+
+    now = datetime.now()
+    with data.connect_to_mongo() as client:
+        db = client['Ganesha_News']
+        try:
+            db['locks'].find_one_and_update(
+                {"_id": "update", "$or": [{"expires_at": {"$lt": now}}, {"owner": owner}]},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=lease_seconds)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return True
+        except DuplicateKeyError:
+            # the lock exists and is held by another worker
+            return False
+
+
+def release_update_lock(owner: str):
+    with data.connect_to_mongo() as client:
+        db = client['Ganesha_News']
+        db['locks'].delete_one({"_id": "update", "owner": owner})
+
+
+def keep_lock_alive(owner: str, stop: Event, lease_seconds=LOCK_LEASE_SECONDS):
+    while not stop.wait(lease_seconds / 3):
+        try:
+            if not acquire_update_lock(owner, lease_seconds):
+                print('Warning: the update lock was lost')
+        except Exception as e:
+            print(f'Renew update lock failed: {e}')
+
+
+def claim_job(owner: str):
+    """
+    Take the oldest queued job, the caller must hold the update lock.
+
+    Returns
+    ----------
+    dict | None
+    """
+
+    with data.connect_to_mongo() as client:
+        db = client['Ganesha_News']
+
+        # a running job without lock holder was left by a dead worker, it's resumed
+        db['update_jobs'].update_many({"status": "running"}, {"$set": {"status": "queued"}})
+
+        return db['update_jobs'].find_one_and_update(
+            {"status": "queued"},
+            {"$set": {"status": "running", "worker": owner, "started_at": datetime.now()}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+
+def finish_job(job_id, error: str = None, generation: int = None):
+    with data.connect_to_mongo() as client:
+        db = client['Ganesha_News']
+        db['update_jobs'].update_one(
+            {"_id": job_id},
+            {"$set": {
+                "status": "failed" if error is not None else "done",
+                "error": error,
+                "generation": generation,
+                "finished_at": datetime.now()
+            }}
+        )
+
+
+def run_next_job(owner: str):
+    """
+    Run the oldest queued update job under the update lock then publish its result.
+
+    Returns
+    ----------
+    bool
+        False if there was no job to run (or another worker holds the lock).
+    """
+
+    if not acquire_update_lock(owner):
+        return False
+
+    stop = Event()
+    Thread(target=keep_lock_alive, args=(owner, stop), daemon=True).start()
+    try:
+        job = claim_job(owner)
+        if job is None:
+            return False
+
+        print(f"\nRun update job {job['_id']}")
+        try:
+            generation = update_new_articles(**job['params'])
+            if generation is not None:
+                data.publish_update(generation)
+                print(f'Published generation {generation}')
+            finish_job(job['_id'], generation=generation)
+        except Exception as e:
+            traceback.print_exc()
+            finish_job(job['_id'], error=str(e))
+
+        return True
+    finally:
+        stop.set()
+        release_update_lock(owner)
+
+
+def run_worker(poll_interval=60, interval_hours=UPDATE_INTERVAL_HOURS):
+    """
+    Updater worker, runs outside of the API process (python -m server.worker).
+
+    Enqueue the periodic update and run the queued jobs one at a time.
+    The worker and the API must share the data directory.
+
+    The NNDescent kernels are compiled in the background when the worker starts,
+    the first job crawls in the meantime (they are kept for the next jobs).
+    """
+
+    owner = get_worker_id()
+    prepare_collections()
+    Thread(target=warmup, daemon=True).start()
+    print(f'Updater worker {owner} started')
+    while True:
+        try:
+            schedule_update(interval_hours)
+            while run_next_job(owner):
+                pass
+        except Exception as e:
+            print(f'Worker error: {e}')
+
+        sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    run_worker()